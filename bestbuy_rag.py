@@ -0,0 +1,3325 @@
+import os
+import re
+import gc
+import argparse
+import json
+import pickle
+import shutil
+import hashlib
+import sqlite3
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from contextlib import contextmanager
+from string import Formatter
+import faiss
+import torch
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import load_dataset
+from huggingface_hub import HfApi
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.embeddings.base import Embeddings
+from sentence_transformers import CrossEncoder, SentenceTransformer
+from langchain.vectorstores import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.prompts import PromptTemplate
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+
+REVIEWS_DATASET = "ValerianFourel/bestbuy-reviews"
+PRODUCTS_DATASET = "ValerianFourel/bestbuy-products"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+INDEX_FORMAT_VERSION = 7
+FALLBACK_DOCUMENTS = ["Sample product review text for testing"]
+LLM_MODEL = "meta-llama/Llama-2-7b-chat-hf"
+# hf: transformers (4-bit on CUDA); llama_cpp: GGUF on CPU; ctranslate2: int8 on CPU
+LLM_BACKENDS = ["hf", "llama_cpp", "ctranslate2"]
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "hf")
+LLM_THREADS = int(os.environ.get("LLM_THREADS", str(os.cpu_count() or 1)))
+LLAMA_CPP_REPO = os.environ.get("LLAMA_CPP_REPO", "TheBloke/Llama-2-7B-Chat-GGUF")
+LLAMA_CPP_FILE = os.environ.get("LLAMA_CPP_FILE", "llama-2-7b-chat.Q4_K_M.gguf")
+LLAMA_CPP_CONTEXT = int(os.environ.get("LLAMA_CPP_CONTEXT", "4096"))
+CT2_MODEL_DIR = os.environ.get(
+    "CT2_MODEL_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "bestbuy_rag", "llama-2-7b-chat-ct2-int8")
+)
+# Most requests decoded together in one forward pass
+GENERATION_BATCH_SIZE = int(os.environ.get("GENERATION_BATCH_SIZE", "8"))
+# Steps of initialize_system, in order
+INIT_STAGES = ["index", "llm", "warmup"]
+WARMUP_QUESTION = "Which phone has the best battery life?"
+WARMUP_TOKENS = 8
+CONTEXT_PACKING = os.environ.get("CONTEXT_PACKING", "1") == "1"
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "20"))
+# Prompt plus answer, and the part of it kept for the answer, in tokens
+MAX_LENGTH = 4096
+ANSWER_TOKENS = int(os.environ.get("ANSWER_TOKENS", "256"))
+TOKEN_COUNT_BATCH_SIZE = 1024
+SESSION_TURNS = int(os.environ.get("SESSION_TURNS", "20"))
+SESSION_KB = float(os.environ.get("SESSION_KB", "64"))
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "1800"))
+SESSION_STORE_MB = float(os.environ.get("SESSION_STORE_MB", "64"))
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_ENTRIES", "1000"))
+SEMANTIC_CACHE_MB = float(os.environ.get("SEMANTIC_CACHE_MB", "16"))
+# 0 picks one worker per EMBEDDING_THREADS cores
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", "0"))
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "2"))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "256"))
+QUERY_CACHE_ENTRIES = int(os.environ.get("QUERY_CACHE_ENTRIES", "4096"))
+QUERY_BATCH_WINDOW_MS = float(os.environ.get("QUERY_BATCH_WINDOW_MS", "5"))
+QUERY_BATCH_SIZE = int(os.environ.get("QUERY_BATCH_SIZE", "32"))
+STREAMING_INGEST = os.environ.get("STREAMING_INGEST", "0") == "1"
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "2048"))
+INGEST_MEMORY_LIMIT_MB = int(os.environ.get("INGEST_MEMORY_LIMIT_MB", "0"))
+INDEX_TYPES = ["flat", "ivf", "hnsw"]
+FAISS_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+FAISS_NLIST = int(os.environ.get("FAISS_NLIST", "1024"))
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+FAISS_HNSW_M = int(os.environ.get("FAISS_HNSW_M", "32"))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+INDEX_LAYOUTS = ["hierarchical", "flat"]
+INDEX_LAYOUT = os.environ.get("INDEX_LAYOUT", "hierarchical")
+SHARD_MODES = ["off", "category", "brand"]
+SHARD_BY = os.environ.get("SHARD_BY", "off")
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", str(os.cpu_count() or 1)))
+PRODUCT_CANDIDATES = int(os.environ.get("PRODUCT_CANDIDATES", "5"))
+PRODUCT_MATCH_DISTANCE = float(os.environ.get("PRODUCT_MATCH_DISTANCE", "1.0"))
+# Filters matching more than this share of chunks over-fetch and drop
+# non-matching hits instead of building a FAISS selector over most labels
+FILTER_SELECTOR_FRACTION = 0.2
+AGGREGATE_ROUTING = os.environ.get("AGGREGATE_ROUTING", "1") == "1"
+AGGREGATE_MAX_PRODUCTS = 10
+AGGREGATE_TOP_REVIEWS = 3
+# mmr: relevance traded against similarity to chunks already picked, plus
+# the caps; caps: ranking order with at most so many chunks per review and
+# per product; off: plain top k
+DIVERSITY_MODES = ["mmr", "caps", "off"]
+DIVERSITY = os.environ.get("DIVERSITY", "mmr")
+DIVERSITY_CANDIDATES = int(os.environ.get("DIVERSITY_CANDIDATES", "20"))
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.7"))
+MAX_CHUNKS_PER_REVIEW = int(os.environ.get("MAX_CHUNKS_PER_REVIEW", "1"))
+MAX_CHUNKS_PER_PRODUCT = int(os.environ.get("MAX_CHUNKS_PER_PRODUCT", "2"))
+RERANK = os.environ.get("RERANK", "0") == "1"
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "20"))
+RERANK_MAX_MS = float(os.environ.get("RERANK_MAX_MS", "50"))
+RERANK_CACHE_ENTRIES = 10000
+QUERY_FILTERS = os.environ.get("QUERY_FILTERS", "1") == "1"
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+INDEX_CACHE_DIR = os.environ.get(
+    "INDEX_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "bestbuy_rag", "indexes")
+)
+# Set to an empty string to always re-encode every chunk
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "bestbuy_rag", "embeddings.sqlite")
+)
+
+# Placeholders name columns of the merged reviews/products frame
+DOCUMENT_TEMPLATE = """
+            Product: {product_name}
+            Brand: {brand}
+            Price: ${price}
+            Category: {category}
+            Model: {product_model}
+            Rating: {rating}
+            Title: {review_title}
+            Review: {review_text}
+            Verified Purchase: {verified_purchase}
+            Helpful Votes: {helpful_count}
+            """
+
+# A number is a price when it has a dollar sign or a currency word, or when
+# the bound is about price: "under $500", "under 500 bucks", "price under 500"
+# and "cheaper than 500" are prices, "more than 2 cameras" and "less than 128
+# storage" are not
+PRICE_WORD = (
+    r"(?:\b(?P<word>prices?|priced|budget|costs?|costing)\b(?:\s+(?:is|of|at|range))?\s+)?"
+)
+CURRENCY = r"(?P<currency>\s*(?:dollars?|bucks|usd)\b)?"
+AMOUNT = r"\d[\d,]*(?:\.\d+)?(?![\d.]|,\d)"
+MAX_PRICE_PATTERN = re.compile(
+    PRICE_WORD + r"\b(?:under|below|less than|at most|up to|max|(?P<comparison>cheaper than))\s+"
+    r"(?P<dollar>\$\s*)?(?P<amount>" + AMOUNT + r")" + CURRENCY
+)
+MIN_PRICE_PATTERN = re.compile(
+    PRICE_WORD + r"\b(?:over|above|more than|at least|min|(?P<comparison>pricier than|more expensive than))\s+"
+    r"(?P<dollar>\$\s*)?(?P<amount>" + AMOUNT + r")" + CURRENCY
+)
+PRICE_RANGE_PATTERN = re.compile(
+    PRICE_WORD + r"\bbetween\s+(?P<dollar>\$\s*)?(?P<low>" + AMOUNT + r")\s+and\s+"
+    r"(?P<high_dollar>\$\s*)?(?P<high>" + AMOUNT + r")" + CURRENCY
+)
+RATING_PATTERN = re.compile(
+    r"\b(at least|over|above|more than|under|below|less than|at most)?\s*([1-5](?:\.\d)?)\s*(\+)?\s*stars?"
+    r"(\s+(?:and|or)\s+(?:up|above|more|higher|better))?"
+)
+VERIFIED_PATTERN = re.compile(r"\bverified\b")
+# Words by which a follow-up refers to a product named earlier
+REFERENCE_PATTERN = re.compile(
+    r"\b(?:it|its|it's|this|that|these|those|they|them|their|one|ones|the (?:first|second|last|other|former|latter))\b"
+)
+
+# Questions answered from per-product aggregates instead of the LLM, checked
+# in this order
+AGGREGATE_INTENTS = [
+    ("verified_share", re.compile(
+        r"\b(?:share|percent(?:age)?|proportion|fraction|how many)\b.*\bverified\b"
+        r"|\bverified\b.*\b(?:share|percent(?:age)?|proportion|fraction)\b"
+    )),
+    ("helpful", re.compile(r"\bmost (?:helpful|upvoted|liked)\b|\bhelpful votes\b")),
+    ("average_rating", re.compile(
+        r"\b(?:average|avg|mean|overall)\s+(?:\w+\s+)?(?:rating|score|stars?)\b|\bhow (?:well )?(?:is|are)\b.*\brated\b"
+    )),
+    ("review_count", re.compile(r"\bhow many\s+(?:\w+\s+)?(?:reviews|ratings)\b|\b(?:number|count) of (?:\w+\s+)?reviews\b")),
+    ("price", re.compile(
+        r"\b(?:what(?:'s| is)|how much is|how much does)\b.*\b(?:price|cost)\b|\bhow much (?:is|does)\b|\bprice of\b"
+    )),
+]
+# Words an aggregate question may use besides the product's name. A question
+# with any other word left ("How much does the S23 battery degrade?") is
+# about something the statistics cannot answer and goes to the LLM.
+AGGREGATE_WORDS = frozenset(
+    "much many average avg mean overall rating ratings rated score stars star well price priced cost costs "
+    "review reviews number count total share percent percentage proportion fraction verified purchase purchases "
+    "buyers customers most helpful upvoted liked votes listed currently right now out 5 phone product model s".split()
+)
+
+# Model numbers such as "SM-S921U" or "MTLT3LL/A" are kept whole as well as split
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-/.][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i in is it its me my of on or "
+    "so than that the their them then there these they this to was what when which who why will "
+    "with would you your".split()
+)
+
+# Everything that is the same for every question comes first, so the
+# generation scheduler computes its KV cache once and reuses it; only the
+# retrieved context, conversation and question are prefilled per request
+QA_PROMPT_PREFIX = """Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+Please provide a specific answer considering:
+- Product specifications and features
+- Price information
+- Brand details
+- User reviews and ratings
+- Any specific requirements mentioned in the question
+
+Focus on providing relevant information about phones that match the criteria.
+
+Product information and reviews:
+
+"""
+
+# Joins the retrieved chunks in the prompt, as LangChain's "stuff" chain did
+DOCUMENT_SEPARATOR = "\n\n"
+
+QA_PROMPT = PromptTemplate(
+    template=QA_PROMPT_PREFIX + """{context}
+
+{question}
+Helpful Answer:""",
+    input_variables=["context", "question"]
+)
+
+# The hierarchical layout embeds the product header once per product and
+# only the review-specific lines per review chunk
+PRODUCT_TEMPLATE = """
+            Product: {product_name}
+            Brand: {brand}
+            Price: ${price}
+            Category: {category}
+            Model: {product_model}
+            """
+
+REVIEW_TEMPLATE = """
+            Rating: {rating}
+            Title: {review_title}
+            Review: {review_text}
+            Verified Purchase: {verified_purchase}
+            Helpful Votes: {helpful_count}
+            """
+
+def column_as_text(column):
+    if pd.api.types.is_string_dtype(column) and not column.isna().any():
+        return pa.array(column.to_numpy(dtype=object), type=pa.large_string())
+
+    # Render each distinct value once with str(), exactly as an f-string
+    # would (None, nan, 5.0, True), then broadcast it back to every row.
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    rendered = np.array([str(value) for value in uniques], dtype=object)
+    return pa.array(rendered[codes], type=pa.large_string())
+
+def build_combined_text(df, template=DOCUMENT_TEMPLATE):
+    parts = []
+    for literal, field, _, _ in Formatter().parse(template):
+        if literal:
+            parts.append(pa.scalar(literal, type=pa.large_string()))
+        if field is not None:
+            parts.append(column_as_text(df[field]))
+
+    combined = pc.binary_join_element_wise(*parts, pa.scalar("", type=pa.large_string()))
+    return pd.Series(combined.to_numpy(zero_copy_only=False), index=df.index)
+
+def review_ids(df):
+    # A review is identified by what the scraper sees, so a re-scraped review
+    # maps to the same ID even if its text or vote counts changed.
+    keys = build_combined_text(df, "{product_name}|{author}|{submission_date}|{review_title}")
+    return keys.map(lambda key: hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+def price_values(column):
+    # Prices come as numbers or as text such as "$1,299.99"
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype(float)
+    return pd.to_numeric(column.astype(str).str.replace(r"[^0-9.]", "", regex=True), errors="coerce")
+
+def flag_values(column):
+    if pd.api.types.is_bool_dtype(column):
+        return column
+    return column.astype(str).str.strip().str.lower().isin(["true", "1", "yes", "y", "verified purchase"])
+
+def lexical_tokens(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-/.]", token) if part and part not in STOPWORDS)
+    return tokens
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    scores = {}
+    for ranking in rankings:
+        for rank, label in enumerate(ranking):
+            scores[label] = scores.get(label, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+def price_value(text):
+    return float(text.replace("$", "").replace(",", "").strip())
+
+def price_match(pattern, text):
+    # The first match that a dollar sign, a currency word or a price word
+    # marks as a price
+    for match in pattern.finditer(text):
+        marks = [value for name, value in match.groupdict().items() if name not in ("amount", "low", "high")]
+        if any(marks):
+            return match
+    return None
+
+def plural(count, noun):
+    return f"{count} {noun}" if count == 1 else f"{count} {noun}s"
+
+def product_id(product_name):
+    return hashlib.sha1(str(product_name).encode("utf-8")).hexdigest()[:16]
+
+def faiss_id(chunk_id):
+    # FAISS labels are signed 64-bit integers; 60 bits of the hash keep them positive
+    return int(hashlib.sha1(chunk_id.encode("utf-8")).hexdigest()[:15], 16)
+
+def ivf_labels(index):
+    # Every label stored in an IVF index, list by list
+    invlists = index.invlists
+    return np.concatenate([np.empty(0, dtype=np.int64)] + [
+        faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+        for list_no in range(index.nlist) if invlists.list_size(list_no)
+    ])
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return 0
+
+class ReadWriteLock:
+    # Searches share the index; an upsert or delete has it to itself. New
+    # searches wait while an update is waiting, so updates are not starved,
+    # and a thread already searching may enter again (prepare_answer calls
+    # retrieve) without queueing behind that update.
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing_now = False
+        self.waiting_writers = 0
+        self.local = threading.local()
+
+    @contextmanager
+    def reading(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            with self.condition:
+                while self.writing_now or self.waiting_writers:
+                    self.condition.wait()
+                self.readers += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                with self.condition:
+                    self.readers -= 1
+                    if not self.readers:
+                        self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing_now or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing_now = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing_now = False
+                self.condition.notify_all()
+
+class ChunkTable:
+    # One row per indexed review chunk, kept as numpy columns so restricting a
+    # search to a subset of chunks is array arithmetic rather than dict scans.
+    # Brand and category are stored as codes into a per-table vocabulary;
+    # missing values are -1 (or NaN for price and rating).
+
+    CATEGORICAL = ("brand", "category")
+
+    def __init__(self, columns=None, vocab=None):
+        self.columns = columns or {
+            "label": np.empty(0, dtype=np.int64),
+            "product": np.empty(0, dtype=np.int64),
+            "price": np.empty(0, dtype=np.float64),
+            "rating": np.empty(0, dtype=np.float64),
+            "brand": np.empty(0, dtype=np.int32),
+            "category": np.empty(0, dtype=np.int32),
+            "verified": np.empty(0, dtype=np.int8),
+        }
+        self.vocab = vocab or {name: [] for name in self.CATEGORICAL}
+        self.codes = {name: {value: code for code, value in enumerate(values)} for name, values in self.vocab.items()}
+        self.sorted = None
+
+    def __len__(self):
+        return len(self.columns["label"])
+
+    @staticmethod
+    def normalize(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)) or not str(value).strip():
+            return None
+        return str(value).strip().lower()
+
+    def code(self, name, value):
+        value = self.normalize(value)
+        if value is None:
+            return -1
+        if value not in self.codes[name]:
+            self.codes[name][value] = len(self.vocab[name])
+            self.vocab[name].append(value)
+        return self.codes[name][value]
+
+    def add(self, texts):
+        metadatas = [text.metadata for text in texts]
+        rows = {
+            "label": np.array([faiss_id(metadata["chunk_id"]) for metadata in metadatas], dtype=np.int64),
+            "product": np.array([faiss_id(metadata.get("product_id", "")) for metadata in metadatas], dtype=np.int64),
+            "price": np.array([metadata.get("price", np.nan) for metadata in metadatas], dtype=np.float64),
+            "rating": np.array([metadata.get("rating", np.nan) for metadata in metadatas], dtype=np.float64),
+            "brand": np.array([self.code("brand", metadata.get("brand")) for metadata in metadatas], dtype=np.int32),
+            "category": np.array([self.code("category", metadata.get("category")) for metadata in metadatas], dtype=np.int32),
+            "verified": np.array([metadata.get("verified_purchase", False) for metadata in metadatas], dtype=np.int8),
+        }
+        for name, values in rows.items():
+            self.columns[name] = np.concatenate([self.columns[name], values])
+        self.sorted = None
+
+    def remove(self, labels):
+        keep = ~np.isin(self.columns["label"], labels)
+        self.columns = {name: values[keep] for name, values in self.columns.items()}
+        self.sorted = None
+
+    def sorted_columns(self):
+        # Each column sorted once (and again after an update), so a filter is
+        # a pair of binary searches instead of a pass over every chunk. Built
+        # aside and assigned whole, since concurrent searches may both build it.
+        sorted_columns = self.sorted
+        if sorted_columns is None:
+            sorted_columns = {}
+            for name, values in self.columns.items():
+                order = np.argsort(values, kind="stable")
+                sorted_columns[name] = (order, values[order])
+            self.sorted = sorted_columns
+        return sorted_columns
+
+    def predicates(self, filters, products=None):
+        # Each predicate is a column and the closed ranges it may fall in
+        predicates = []
+        if products is not None:
+            predicates.append(("product", [(label, label) for label in products]))
+        for name in self.CATEGORICAL:
+            if filters.get(name):
+                code = self.codes[name].get(str(filters[name]).strip().lower(), -2)
+                predicates.append((name, [(code, code)]))
+        for name in ("price", "rating"):
+            low, high = filters.get(f"min_{name}"), filters.get(f"max_{name}")
+            if low is not None or high is not None:
+                predicates.append((name, [(-np.inf if low is None else low, np.inf if high is None else high)]))
+        if filters.get("verified") is not None:
+            predicates.append(("verified", [(int(filters["verified"]), int(filters["verified"]))]))
+        return predicates
+
+    def select(self, filters, products=None):
+        # Returns the rows matching every filter, or None when nothing is filtered
+        predicates = self.predicates(filters or {}, products)
+        if not predicates:
+            return None
+
+        sorted_columns = self.sorted_columns()
+        bounds = []
+        for name, ranges in predicates:
+            values = sorted_columns[name][1]
+            slices = [(np.searchsorted(values, low, "left"), np.searchsorted(values, high, "right")) for low, high in ranges]
+            bounds.append((sum(stop - start for start, stop in slices), name, ranges, slices))
+
+        # Start from the most selective predicate and check the others only on its rows
+        bounds.sort(key=lambda bound: bound[0])
+        _, name, _, slices = bounds[0]
+        order = sorted_columns[name][0]
+        rows = np.concatenate([order[start:stop] for start, stop in slices])
+        for _, name, ranges, _ in bounds[1:]:
+            values = self.columns[name][rows]
+            keep = np.zeros(len(rows), dtype=bool)
+            for low, high in ranges:
+                keep |= (values >= low) & (values <= high)
+            rows = rows[keep]
+        return rows
+
+    def values(self, name, rows):
+        # Distinct brand or category values of the given rows, "" for missing
+        return [self.vocab[name][code] if code >= 0 else "" for code in np.unique(self.columns[name][rows]).tolist()]
+
+    def contains(self, labels, rows):
+        # Which of the given labels belong to the selected rows
+        order, sorted_labels = self.sorted_columns()["label"]
+        positions = np.minimum(np.searchsorted(sorted_labels, labels), len(sorted_labels) - 1)
+        selected = np.zeros(len(self), dtype=bool)
+        selected[rows] = True
+        return (sorted_labels[positions] == labels) & selected[order[positions]]
+
+    def save(self, path):
+        vocab = {f"vocab_{name}": np.array(values, dtype=str) for name, values in self.vocab.items()}
+        np.savez(path, **self.columns, **vocab)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {name: data[name] for name in data.files if not name.startswith("vocab_")}
+            vocab = {name[len("vocab_"):]: data[name].tolist() for name in data.files if name.startswith("vocab_")}
+        return cls(columns, vocab)
+
+class ShardedIndex:
+    # Review vectors split by brand or category, one FAISS index per value.
+    # A search runs on every shard in parallel (FAISS releases the GIL) and
+    # the per-shard top k are merged by distance; subset() restricts it to
+    # the shards a query's filters can match. Shards are saved as separate
+    # files, so each can be mapped or served on its own.
+
+    def __init__(self, shard_by, shards=None, pool=None):
+        self.shard_by = shard_by
+        self.shards = shards if shards is not None else {}
+        self.pool = pool
+
+    @property
+    def ntotal(self):
+        return sum(shard.ntotal for shard in self.shards.values())
+
+    @property
+    def d(self):
+        return next(iter(self.shards.values())).d
+
+    def key(self, metadata):
+        return ChunkTable.normalize(metadata.get(self.shard_by)) or ""
+
+    def subset(self, keys):
+        return ShardedIndex(self.shard_by, {key: self.shards[key] for key in keys if key in self.shards}, self.pool)
+
+    def search(self, query_vector, k, params=None):
+        shards = [shard for shard in self.shards.values() if shard.ntotal]
+        if not shards:
+            return np.full((len(query_vector), k), np.inf, dtype=np.float32), np.full((len(query_vector), k), -1)
+
+        def search_shard(shard):
+            return shard.search(query_vector, k, params=params)
+
+        if self.pool is not None and len(shards) > 1:
+            results = list(self.pool.map(search_shard, shards))
+        else:
+            results = [search_shard(shard) for shard in shards]
+        distances = np.concatenate([distances for distances, _ in results], axis=1)
+        labels = np.concatenate([labels for _, labels in results], axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    def reconstruct_batch(self, labels, keys):
+        vectors = np.empty((len(labels), self.d), dtype=np.float32)
+        keys = np.array(keys)
+        for key in set(keys.tolist()):
+            vectors[keys == key] = self.shards[key].reconstruct_batch(labels[keys == key])
+        return vectors
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        files = {}
+        for i, (key, shard) in enumerate(sorted(self.shards.items())):
+            files[key] = f"{i}.faiss"
+            faiss.write_index(shard, os.path.join(path, files[key]))
+        with open(os.path.join(path, "shards.json"), "w") as f:
+            json.dump({"shard_by": self.shard_by, "files": files}, f, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, read_index, pool=None):
+        # read_index(path) returns (index, read_only), as for an unsharded index
+        with open(os.path.join(path, "shards.json")) as f:
+            layout = json.load(f)
+        index, read_only = cls(layout["shard_by"], pool=pool), False
+        for key, name in layout["files"].items():
+            index.shards[key], shard_read_only = read_index(os.path.join(path, name))
+            read_only = read_only or shard_read_only
+        return index, read_only
+
+worker_model = None
+
+def init_embedding_worker(model_name, threads):
+    global worker_model
+    torch.set_num_threads(threads)
+    worker_model = SentenceTransformer(model_name, device="cpu")
+
+def encode_in_worker(texts):
+    return worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False, convert_to_numpy=True)
+
+class EmbeddingEngine(Embeddings):
+    # Drop-in for HuggingFaceEmbeddings during index builds. Chunks are sorted
+    # by token length so each batch pads to similar lengths, and large jobs
+    # are spread over a pool of worker processes with a few threads each.
+
+    def __init__(self, model_name=EMBEDDING_MODEL, workers=EMBEDDING_WORKERS,
+                 threads_per_worker=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        self.threads_per_worker = threads_per_worker
+        self.workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        if torch.cuda.is_available():
+            # One process owns the GPU and is fed large batches instead
+            self.workers = 1
+        self.batch_size = batch_size
+        self.model = None
+        self.tokenizer = None
+        self.pool = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.encoded = 0
+        self.seconds = 0.0
+
+    def local_model(self):
+        if self.model is None:
+            self.model = SentenceTransformer(self.model_name)
+        return self.model
+
+    def token_lengths(self, texts):
+        if self.workers == 1:
+            tokenizer, max_length = self.local_model().tokenizer, self.local_model().max_seq_length
+        else:
+            # Only the tokenizer is needed in this process when workers encode
+            if self.tokenizer is None:
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            tokenizer, max_length = self.tokenizer, self.tokenizer.model_max_length
+        return np.array([len(ids) for ids in tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]])
+
+    def start_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_embedding_worker,
+                initargs=(self.model_name, self.threads_per_worker)
+            )
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        start = time.perf_counter()
+        # Same preprocessing as HuggingFaceEmbeddings, so vectors are interchangeable
+        texts = [text.replace("\n", " ") for text in texts]
+
+        # Longest first, so the most expensive batches are not left for last
+        order = np.argsort(-self.token_lengths(texts), kind="stable")
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+
+        if self.workers > 1 and len(batches) > 1:
+            results = self.start_pool().map(encode_in_worker, batch_texts)
+        else:
+            model = self.local_model()
+            results = (
+                model.encode(chunk, batch_size=len(chunk), show_progress_bar=False, convert_to_numpy=True)
+                for chunk in batch_texts
+            )
+
+        vectors = None
+        for batch, batch_vectors in zip(batches, results):
+            if vectors is None:
+                vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+            vectors[batch] = batch_vectors
+
+        self.encoded += len(texts)
+        self.seconds += time.perf_counter() - start
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.local_model().encode(text.replace("\n", " "), show_progress_bar=False).tolist()
+
+    def report(self):
+        if self.encoded:
+            print(f"Embedded {self.encoded} chunks in {self.seconds:.1f}s "
+                  f"({self.encoded / self.seconds:.0f} chunks/sec, "
+                  f"{self.workers} workers x {self.threads_per_worker} threads)")
+
+class QueryEncoder:
+    # Embeds questions for retrieval and the answer cache. Repeated questions
+    # are served from an LRU cache keyed by normalized text; the others are
+    # queued, and a background thread encodes whatever arrives within
+    # window_ms of the first one in a single call. Identical questions
+    # already queued share one encoding.
+
+    def __init__(self, embeddings, cache_entries=QUERY_CACHE_ENTRIES, window_ms=QUERY_BATCH_WINDOW_MS,
+                 max_batch_size=QUERY_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.cache_entries = cache_entries
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.batch_sizes = {}
+
+    @staticmethod
+    def normalize(text):
+        # The embedding model is uncased, so case and spacing do not change the vector
+        return " ".join(text.lower().split())
+
+    def encode(self, text):
+        key = self.normalize(text)
+        with self.lock:
+            vector = self.cache.get(key)
+            if vector is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.in_flight[key] = Future()
+                self.pending.put(key)
+            else:
+                self.shared += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return future.result()
+
+    def run(self):
+        while True:
+            keys = [self.pending.get()]
+            deadline = time.monotonic() + self.window_ms / 1000
+            while len(keys) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    keys.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            vectors, error = None, None
+            try:
+                vectors = np.asarray(self.embeddings.embed_documents(keys), dtype=np.float32)
+            except Exception as e:
+                error = e
+
+            with self.lock:
+                self.batch_sizes[len(keys)] = self.batch_sizes.get(len(keys), 0) + 1
+                futures = [self.in_flight.pop(key) for key in keys]
+                if error is None:
+                    for key, vector in zip(keys, vectors):
+                        self.cache[key] = vector
+                    while len(self.cache) > self.cache_entries:
+                        self.cache.popitem(last=False)
+            for i, future in enumerate(futures):
+                if error is None:
+                    future.set_result(vectors[i])
+                else:
+                    future.set_exception(error)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            batches = sum(self.batch_sizes.values())
+            encoded = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "lookups": lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "shared": self.shared,
+                "batches": batches,
+                "mean_batch_size": encoded / batches if batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            }
+
+class EmbeddingCache:
+    # Chunk vectors stored in SQLite under a hash of the embedding model and
+    # the chunk text, so changing the chunking, template or dataset revision
+    # only encodes text that has not been embedded before
+
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self.connection = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL) WITHOUT ROWID"
+            )
+            # Running totals of encoding time, used to estimate the time saved by hits
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        return self.connection
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).digest()
+
+    def lookup(self, keys):
+        connection = self.connect()
+        found = {}
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            found.update(connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            ))
+        return found
+
+    def embed(self, embeddings, texts):
+        keys = [self.key(text) for text in texts]
+        cached = self.lookup(list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        self.hits += sum(key in cached for key in keys)
+        self.misses += sum(key not in cached for key in keys)
+
+        if missing:
+            start = time.perf_counter()
+            vectors = np.asarray(embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            seconds = time.perf_counter() - start
+            encoded = dict(zip(missing, (vector.tobytes() for vector in vectors)))
+            with self.connect() as connection:
+                connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", encoded.items())
+                connection.executemany(
+                    "INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    [("encode_seconds", seconds), ("encoded_texts", len(missing))]
+                )
+            cached.update(encoded)
+
+        return np.vstack([np.frombuffer(cached[key], dtype=np.float32) for key in keys])
+
+    def seconds_per_text(self):
+        stats = dict(self.connect().execute("SELECT name, value FROM stats"))
+        return stats.get("encode_seconds", 0.0) / stats["encoded_texts"] if stats.get("encoded_texts") else 0.0
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            saved = self.hits * self.seconds_per_text()
+            print(f"Embedding cache: {self.hits}/{total} chunks reused ({self.hits / total:.0%} hit rate), "
+                  f"about {saved:.1f}s of encoding saved")
+
+class LexicalIndex:
+    # BM25 over review chunks. Postings are integer arrays (term id, chunk
+    # number, term frequency) grouped by term into CSR form on first search,
+    # so a query term is one slice. Chunks are referred to by FAISS label.
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, vocab=None, labels=None, lengths=None, postings=None):
+        self.vocab = vocab or []
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.vocab)}
+        self.labels = labels if labels is not None else np.empty(0, dtype=np.int64)
+        self.lengths = lengths if lengths is not None else np.empty(0, dtype=np.int32)
+        self.segments = [postings] if postings is not None else []
+        self.csr = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def document_text(text):
+        return f"{text.page_content} {text.metadata.get('product_model') or ''}"
+
+    def add(self, texts):
+        term_ids, doc_ids, lengths = [], [], []
+        for doc, text in enumerate(texts, start=len(self.labels)):
+            tokens = lexical_tokens(self.document_text(text))
+            term_ids.extend(self.term_ids.setdefault(token, len(self.term_ids)) for token in tokens)
+            doc_ids.extend([doc] * len(tokens))
+            lengths.append(len(tokens))
+        self.vocab.extend(list(self.term_ids)[len(self.vocab):])
+
+        # Count each (chunk, term) pair once with a single unique over packed keys
+        keys, counts = np.unique(
+            (np.asarray(doc_ids, dtype=np.int64) << 32) | np.asarray(term_ids, dtype=np.int64),
+            return_counts=True
+        )
+        self.segments.append((
+            (keys & 0xFFFFFFFF).astype(np.int32),
+            (keys >> 32).astype(np.int32),
+            np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16),
+        ))
+        self.labels = np.concatenate([
+            self.labels, np.array([faiss_id(text.metadata["chunk_id"]) for text in texts], dtype=np.int64)
+        ])
+        self.lengths = np.concatenate([self.lengths, np.array(lengths, dtype=np.int32)])
+        self.csr = None
+
+    def postings(self):
+        if len(self.segments) != 1:
+            self.segments = [tuple(
+                np.concatenate([segment[i] for segment in self.segments]) if self.segments
+                else np.empty(0, dtype=dtype)
+                for i, dtype in enumerate((np.int32, np.int32, np.uint16))
+            )]
+        return self.segments[0]
+
+    def remove(self, labels):
+        keep = ~np.isin(self.labels, labels)
+        if keep.all():
+            return
+        terms, docs, freqs = self.postings()
+        renumber = np.cumsum(keep) - 1
+        kept = keep[docs]
+        self.segments = [(terms[kept], renumber[docs[kept]].astype(np.int32), freqs[kept])]
+        self.labels = self.labels[keep]
+        self.lengths = self.lengths[keep]
+        self.csr = None
+
+    def search(self, query, k, keep=None):
+        # Returns up to k labels, best first; keep masks out labels that fail
+        # the retrieval filters
+        if self.csr is None:
+            terms, docs, freqs = self.postings()
+            order = np.argsort(terms, kind="stable")
+            offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(terms, minlength=len(self.vocab)), out=offsets[1:])
+            self.csr = (offsets, docs[order], freqs[order])
+        offsets, docs, freqs = self.csr
+
+        query_terms = {self.term_ids[token] for token in lexical_tokens(query) if token in self.term_ids}
+        if not query_terms or not len(self.labels):
+            return np.empty(0, dtype=np.int64)
+
+        num_docs = len(self.labels)
+        average_length = max(self.lengths.mean(), 1.0)
+        matched, scores = [], []
+        for term_id in query_terms:
+            term_docs = docs[offsets[term_id]:offsets[term_id + 1]]
+            term_freqs = freqs[offsets[term_id]:offsets[term_id + 1]].astype(np.float32)
+            idf = np.log(1.0 + (num_docs - len(term_docs) + 0.5) / (len(term_docs) + 0.5))
+            norm = self.K1 * (1.0 - self.B + self.B * self.lengths[term_docs] / average_length)
+            matched.append(term_docs)
+            scores.append(idf * term_freqs * (self.K1 + 1.0) / (term_freqs + norm))
+
+        matched, inverse = np.unique(np.concatenate(matched), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        labels = self.labels[matched]
+        if keep is not None:
+            mask = keep(labels)
+            labels, scores = labels[mask], scores[mask]
+        if len(labels) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            labels, scores = labels[top], scores[top]
+        return labels[np.argsort(-scores, kind="stable")]
+
+    def save(self, path):
+        terms, docs, freqs = self.postings()
+        np.savez(path, vocab=np.array(self.vocab, dtype=str), labels=self.labels, lengths=self.lengths,
+                 terms=terms, docs=docs, freqs=freqs)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["vocab"].tolist(), data["labels"], data["lengths"],
+                       (data["terms"], data["docs"], data["freqs"]))
+
+class ProductAggregates:
+    # Per-product review statistics over the merged reviews/products data.
+    # Each review's contribution is kept, so an upsert or delete adjusts the
+    # sums of the products it touches instead of recomputing them.
+
+    def __init__(self):
+        # review ID -> (product ID, rating, verified, helpful votes, title, author)
+        self.reviews = {}
+        self.products = {}
+        self.product_reviews = {}
+        # name and model tokens -> product IDs, for finding the product a question names
+        self.token_products = {}
+
+    def __len__(self):
+        return len(self.products)
+
+    def add(self, merged_df):
+        merged_df = merged_df.assign(review_id=review_ids(merged_df))
+        merged_df = merged_df.drop_duplicates('review_id', keep='last')
+        self.remove(merged_df['review_id'])
+
+        prices = price_values(merged_df['price'])
+        ratings = pd.to_numeric(merged_df['rating'], errors='coerce')
+        helpful = pd.to_numeric(merged_df['helpful_count'], errors='coerce').fillna(0).astype(int)
+        verified = flag_values(merged_df['verified_purchase'])
+        for review_id, name, model, price, rating, is_verified, votes, title, author in zip(
+            merged_df['review_id'], merged_df['product_name'], merged_df['product_model'], prices, ratings,
+            verified, helpful, merged_df['review_title'], merged_df['author']
+        ):
+            if pd.isna(name):
+                continue
+            pid = product_id(name)
+            product = self.products.get(pid)
+            if product is None:
+                product = self.products[pid] = {
+                    "name": name, "model": None, "price": np.nan,
+                    "reviews": 0, "rated": 0, "rating_sum": 0.0, "verified": 0,
+                }
+                self.product_reviews[pid] = set()
+            # The latest rows carry the current price and model
+            if not pd.isna(price):
+                product["price"] = float(price)
+            if not pd.isna(model):
+                product["model"] = model
+            for token in lexical_tokens(f"{name} {product['model'] or ''}"):
+                self.token_products.setdefault(token, set()).add(pid)
+
+            rating = None if pd.isna(rating) else float(rating)
+            self.reviews[review_id] = (pid, rating, bool(is_verified), int(votes), title, author)
+            self.product_reviews[pid].add(review_id)
+            self.update(pid, rating, bool(is_verified), 1)
+
+    def update(self, pid, rating, verified, sign):
+        product = self.products[pid]
+        product["reviews"] += sign
+        product["verified"] += sign * verified
+        if rating is not None:
+            product["rated"] += sign
+            product["rating_sum"] += sign * rating
+
+    def remove(self, review_ids):
+        for review_id in review_ids:
+            review = self.reviews.pop(review_id, None)
+            if review is not None:
+                pid, rating, verified = review[:3]
+                self.product_reviews[pid].discard(review_id)
+                self.update(pid, rating, verified, -1)
+
+    def match(self, query):
+        # Products sharing the rarest tokens with the question; variants of
+        # one model (colours, storage) tie and are all returned
+        query_tokens = set(lexical_tokens(query))
+        scores = {}
+        for token in query_tokens:
+            pids = self.token_products.get(token, ())
+            weight = np.log(1 + len(self.products) / len(pids)) if pids else 0.0
+            for pid in pids:
+                scores[pid] = scores.get(pid, 0.0) + weight
+        if not scores:
+            return []
+        best = max(scores.values())
+        matched = [pid for pid, score in scores.items() if score >= best - 1e-9]
+        return matched if len(matched) <= AGGREGATE_MAX_PRODUCTS else []
+
+    def describe(self, intent, pid):
+        product = self.products[pid]
+        name = product["name"]
+        if intent == "average_rating":
+            if not product["rated"]:
+                return f"{name} has no rated reviews yet."
+            average = product["rating_sum"] / product["rated"]
+            return f"{name} has an average rating of {average:.2f} out of 5 from {plural(product['rated'], 'review')}."
+        if intent == "review_count":
+            return f"{name} has {plural(product['reviews'], 'review')}."
+        if intent == "price":
+            if np.isnan(product["price"]):
+                return f"No price is listed for {name}."
+            return f"{name} is listed at ${product['price']:,.2f}."
+        if intent == "verified_share":
+            if not product["reviews"]:
+                return f"{name} has no reviews yet."
+            share = product["verified"] / product["reviews"]
+            return (f"{share:.0%} of the reviews of {name} are verified purchases "
+                    f"({product['verified']} of {product['reviews']}).")
+        # helpful
+        leaders = sorted(
+            (self.reviews[review_id] for review_id in self.product_reviews[pid]),
+            key=lambda review: review[3], reverse=True
+        )[:AGGREGATE_TOP_REVIEWS]
+        if not leaders:
+            return f"{name} has no reviews yet."
+        lines = [f"Most helpful reviews of {name}:"]
+        for _, rating, _, votes, title, author in leaders:
+            rating = f"{rating:g}/5, " if rating is not None else ""
+            lines.append(f'- "{title}" by {author} ({rating}{plural(votes, "helpful vote")})')
+        return "\n".join(lines)
+
+    def answer(self, query):
+        # None when the question is not an aggregate question about a known product
+        text = query.lower()
+        intent = next((name for name, pattern in AGGREGATE_INTENTS if pattern.search(text)), None)
+        if intent is None:
+            return None
+        matched = self.match(text)
+        if not matched:
+            return None
+        named = {
+            token for pid in matched
+            for token in lexical_tokens(f"{self.products[pid]['name']} {self.products[pid]['model'] or ''}")
+        }
+        if any(token not in named and token not in AGGREGATE_WORDS for token in lexical_tokens(text)):
+            return None
+        matched.sort(key=lambda pid: self.products[pid]["name"])
+        return "\n".join(self.describe(intent, pid) for pid in matched)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump((self.reviews, self.products, self.product_reviews, self.token_products), f)
+
+    @classmethod
+    def load(cls, path):
+        aggregates = cls()
+        with open(path, "rb") as f:
+            aggregates.reviews, aggregates.products, aggregates.product_reviews, aggregates.token_products = pickle.load(f)
+        return aggregates
+
+class Reranker:
+    # Rescores retrieved chunks against the question with a cross-encoder on
+    # CPU, all candidates in one batch. Scores are cached per question and
+    # chunk text. The number of candidates is capped at max_candidates and
+    # lowered further when the measured cost per pair would exceed max_ms.
+
+    def __init__(self, model_name=RERANK_MODEL, max_candidates=RERANK_CANDIDATES, max_ms=RERANK_MAX_MS,
+                 cache_entries=RERANK_CACHE_ENTRIES):
+        self.model_name = model_name
+        self.model = None
+        self.max_candidates = max_candidates
+        self.max_ms = max_ms
+        self.cache_entries = cache_entries
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.ms_per_pair = None
+        self.calls = 0
+        self.pairs_scored = 0
+        self.cache_hits = 0
+        self.latencies = []
+
+    def local_model(self):
+        if self.model is None:
+            self.model = CrossEncoder(self.model_name, device="cpu")
+        return self.model
+
+    def candidates(self):
+        # How many chunks the next call may score within the latency bound
+        if self.ms_per_pair is None:
+            return self.max_candidates
+        affordable = int(self.max_ms / max(self.ms_per_pair, 1e-6))
+        return max(1, min(self.max_candidates, affordable))
+
+    @staticmethod
+    def key(query, document):
+        return hashlib.sha1(f"{query}\0{document.page_content}".encode("utf-8")).digest()
+
+    def rerank(self, query, documents, k):
+        start = time.perf_counter()
+        # Chunks past the scored ones keep their retrieval order behind them
+        scored = self.candidates()
+        documents, rest = documents[:scored], documents[scored:]
+        keys = [self.key(query, document) for document in documents]
+        with self.lock:
+            scores = [self.scores.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self.scores.move_to_end(key)
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        if missing:
+            model = self.local_model()
+            pair_start = time.perf_counter()
+            new_scores = model.predict(
+                [(query, documents[i].page_content) for i in missing],
+                batch_size=len(missing),
+                show_progress_bar=False
+            )
+            ms_per_pair = (time.perf_counter() - pair_start) * 1000 / len(missing)
+            with self.lock:
+                # Smoothed, so one slow call does not collapse the candidate count
+                self.ms_per_pair = ms_per_pair if self.ms_per_pair is None else 0.8 * self.ms_per_pair + 0.2 * ms_per_pair
+                for i, score in zip(missing, new_scores):
+                    scores[i] = float(score)
+                    self.scores[keys[i]] = scores[i]
+                while len(self.scores) > self.cache_entries:
+                    self.scores.popitem(last=False)
+
+        with self.lock:
+            self.calls += 1
+            self.pairs_scored += len(missing)
+            self.cache_hits += len(documents) - len(missing)
+            self.latencies = self.latencies[-999:] + [(time.perf_counter() - start) * 1000]
+        order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+        return ([documents[i] for i in order] + rest)[:k]
+
+    def stats(self):
+        with self.lock:
+            pairs = self.pairs_scored + self.cache_hits
+            return {
+                "calls": self.calls,
+                "pairs_scored": self.pairs_scored,
+                "cache_hit_rate": self.cache_hits / pairs if pairs else 0.0,
+                "candidates": self.candidates(),
+                "p50_ms": float(np.percentile(self.latencies, 50)) if self.latencies else 0.0,
+                "p95_ms": float(np.percentile(self.latencies, 95)) if self.latencies else 0.0,
+            }
+
+class ContextPacker:
+    # Fills the prompt's context with the best ranked chunks that fit a token
+    # budget. Token counts are stored in the chunk metadata at index time, so
+    # packing tokenizes nothing. Consecutive chunks of a review share
+    # CHUNK_OVERLAP characters; when both are picked they are joined and the
+    # later one only adds what follows the overlap.
+
+    def __init__(self, separator_tokens):
+        # Tokens of the separator placed between documents in the prompt
+        self.separator_tokens = separator_tokens
+
+    @staticmethod
+    def chunk_index(document):
+        return int(document.metadata["chunk_id"].rsplit(":", 1)[1])
+
+    def review_cost(self, chunks):
+        cost = 0
+        for index, document in chunks.items():
+            if index - 1 in chunks and document.metadata["overlap"] > 0:
+                cost += document.metadata["tail_tokens"]
+            else:
+                cost += document.metadata["n_tokens"] + self.separator_tokens
+        return cost
+
+    def start(self, budget, headers=None):
+        # headers maps product IDs to the product documents placed ahead of
+        # their reviews
+        return Packing(self, budget, headers or {})
+
+    def pack(self, documents, budget, headers=None):
+        # documents are ranked best first
+        packing = self.start(budget, headers)
+        for document in documents:
+            # A chunk that does not fit may still leave room for a shorter one
+            packing.add(document)
+        return packing.documents()
+
+class Packing:
+    # Chunks added one at a time to a ContextPacker's budget, so that a
+    # caller choosing them can tell which ones fit
+
+    def __init__(self, packer, budget, headers):
+        self.packer = packer
+        self.budget = budget
+        self.headers = headers
+        self.selected = {}
+        self.products = set()
+        self.used = 0
+
+    def add(self, document):
+        # Returns whether the chunk fit; one that did not is left out
+        chunks = self.selected.get(document.metadata["review_id"], {})
+        candidate = {**chunks, self.packer.chunk_index(document): document}
+        cost = self.packer.review_cost(candidate) - self.packer.review_cost(chunks)
+        product = document.metadata.get("product_id")
+        if product in self.headers and product not in self.products:
+            cost += self.headers[product].metadata["n_tokens"] + self.packer.separator_tokens
+        if self.used + cost > self.budget:
+            return False
+        self.used += cost
+        self.selected[document.metadata["review_id"]] = candidate
+        if product in self.headers:
+            self.products.add(product)
+        return True
+
+    def documents(self):
+        packed = []
+        for chunks in self.selected.values():
+            run = None
+            for index in sorted(chunks):
+                document = chunks[index]
+                if run is not None and index - 1 in chunks and document.metadata["overlap"] > 0:
+                    run.page_content += document.page_content[document.metadata["overlap"]:]
+                else:
+                    run = Document(page_content=document.page_content, metadata=dict(document.metadata))
+                    packed.append(run)
+        return packed
+
+def cache_to_tuples(cache):
+    # Per-layer (key, value) tensors shaped (batch, heads, length, head_dim),
+    # whichever cache class this transformers version returns
+    if isinstance(cache, (tuple, list)):
+        return tuple(cache)
+    if hasattr(cache, "layers"):
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    return cache.to_legacy_cache()
+
+def tuples_to_cache(layers):
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(layers)
+    return DynamicCache(layers)
+
+def left_pad(layers, mask, length):
+    # Pads a batch's cache and attention mask on the left to the given length
+    extra = length - mask.shape[1]
+    if extra <= 0:
+        return layers, mask
+    padded = tuple(
+        tuple(torch.nn.functional.pad(tensor, (0, 0, extra, 0)) for tensor in layer)
+        for layer in layers
+    )
+    return padded, torch.nn.functional.pad(mask, (extra, 0))
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, on_token=None, prefix=None, prefix_length=0):
+        self.prompt_ids = prompt_ids
+        # Shared prompt prefix whose KV cache is reused, and its token count
+        self.prefix = prefix
+        self.prefix_length = prefix_length
+        self.max_new_tokens = max_new_tokens
+        # Called on the scheduler thread with each new piece of text;
+        # returning False stops the generation
+        self.on_token = on_token
+        self.tokens = []
+        self.text = ""
+        self.cancelled = False
+        self.future = Future()
+
+class GenerationScheduler:
+    # Continuous batching: requests join the running batch between decode
+    # steps and leave it as soon as they finish, so concurrent users share
+    # forward passes instead of queueing for the model one at a time.
+    # Sequences are left-padded; the attention mask hides the padding.
+
+    def __init__(self, model, tokenizer, max_length, max_batch_size=GENERATION_BATCH_SIZE,
+                 temperature=0.7, top_p=0.95, repetition_penalty=1.15):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.prefix_ids = {}
+        self.prefix_layers = {}
+        self.prefill_tokens = 0
+        self.reused_prefix_tokens = 0
+
+    def enqueue(self, prompt, on_token=None, prefix=None, max_new_tokens=None):
+        if prefix and len(prompt) > len(prefix) and prompt.startswith(prefix):
+            # The prefix is tokenized on its own so its tokens, and therefore
+            # its cached keys and values, are the same for every request
+            with self.lock:
+                if prefix not in self.prefix_ids:
+                    self.prefix_ids[prefix] = self.tokenizer(prefix, return_tensors="pt").input_ids[0]
+            prefix_ids = self.prefix_ids[prefix]
+            suffix_ids = self.tokenizer(prompt[len(prefix):], add_special_tokens=False, return_tensors="pt").input_ids[0]
+            prompt_ids = torch.cat([prefix_ids, suffix_ids])
+        else:
+            prefix, prefix_ids = None, []
+            prompt_ids = self.tokenizer(prompt, return_tensors="pt").input_ids[0]
+        # Like the pipeline's max_length, the limit covers prompt and answer;
+        # max_new_tokens caps the answer on its own
+        limit = self.max_length - len(prompt_ids)
+        if max_new_tokens is not None:
+            limit = min(limit, max_new_tokens)
+        request = GenerationRequest(prompt_ids, max(1, limit), on_token, prefix, len(prefix_ids))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.pending.put(request)
+        return request
+
+    def submit(self, prompt, prefix=None, max_new_tokens=None):
+        return self.enqueue(prompt, prefix=prefix, max_new_tokens=max_new_tokens).future
+
+    def generate(self, prompt, prefix=None, max_new_tokens=None):
+        return self.submit(prompt, prefix, max_new_tokens).result()
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def stream(self, prompt, prefix=None, max_new_tokens=None):
+        # Yields the answer piece by piece as tokens are decoded
+        pieces = queue.Queue()
+        request = self.enqueue(prompt, on_token=pieces.put, prefix=prefix, max_new_tokens=max_new_tokens)
+        request.future.add_done_callback(lambda future: pieces.put(None))
+        try:
+            while True:
+                piece = pieces.get()
+                if piece is None:
+                    break
+                yield piece
+            request.future.result()
+        finally:
+            # The caller stopped reading early; free the batch slot
+            request.cancelled = True
+
+    def emit(self, request):
+        if request.on_token is None:
+            return
+        text = self.tokenizer.decode(request.tokens, skip_special_tokens=True)
+        # Wait until a character split over several tokens is complete
+        if text.endswith("\ufffd"):
+            return
+        piece, request.text = text[len(request.text):], text
+        if piece and request.on_token(piece) is False:
+            request.cancelled = True
+
+    def sample(self, logits, requests):
+        logits = logits.float()
+        # Repetition penalty over the prompt and everything generated so far
+        for row, request in enumerate(requests):
+            seen = torch.cat([request.prompt_ids, torch.tensor(request.tokens, dtype=torch.long)]).to(logits.device)
+            scores = logits[row].gather(0, seen)
+            scores = torch.where(scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty)
+            logits[row].scatter_(0, seen, scores)
+
+        logits = logits / self.temperature
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True)
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # Keep the smallest set of tokens whose probability reaches top_p
+        outside = probs.cumsum(dim=-1) - probs > self.top_p
+        sorted_logits = sorted_logits.masked_fill(outside, float("-inf"))
+        choice = torch.multinomial(torch.softmax(sorted_logits, dim=-1), 1)
+        return sorted_ids.gather(1, choice).squeeze(1).tolist()
+
+    def forward(self, input_ids, mask, position_ids, layers):
+        device = self.model.device
+        output = self.model(
+            input_ids=input_ids.to(device),
+            attention_mask=mask.to(device),
+            position_ids=position_ids.to(device),
+            past_key_values=tuples_to_cache(layers) if layers else None,
+            use_cache=True
+        )
+        return output.logits[:, -1, :], cache_to_tuples(output.past_key_values)
+
+    def prefix_cache(self, prefix):
+        if prefix not in self.prefix_layers:
+            prefix_ids = self.prefix_ids[prefix]
+            _, self.prefix_layers[prefix] = self.forward(
+                prefix_ids[None, :], torch.ones((1, len(prefix_ids)), dtype=torch.long),
+                torch.arange(len(prefix_ids))[None, :], None
+            )
+        return self.prefix_layers[prefix]
+
+    def prefill(self, requests):
+        # Requests sharing a prefix start from its cached keys and values and
+        # only run their own tokens; padding sits between prefix and suffix
+        prefix_length = requests[0].prefix_length
+        suffixes = [request.prompt_ids[prefix_length:] for request in requests]
+        length = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((len(requests), length), self.tokenizer.eos_token_id, dtype=torch.long)
+        mask = torch.zeros((len(requests), prefix_length + length), dtype=torch.long)
+        mask[:, :prefix_length] = 1
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, length - len(suffix):] = suffix
+            mask[row, prefix_length + length - len(suffix):] = 1
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)[:, prefix_length:]
+
+        layers = None
+        if prefix_length:
+            layers = tuple(
+                tuple(tensor.expand(len(requests), *tensor.shape[1:]) for tensor in layer)
+                for layer in self.prefix_cache(requests[0].prefix)
+            )
+        self.prefill_tokens += sum(len(suffix) for suffix in suffixes)
+        self.reused_prefix_tokens += prefix_length * len(requests)
+        logits, layers = self.forward(input_ids, mask, position_ids, layers)
+        return logits, layers, mask
+
+    def merge(self, layers, mask, new_layers, new_mask):
+        # Appends newly prefilled requests to the running batch
+        if layers is None:
+            return new_layers, new_mask
+        length = max(mask.shape[1], new_mask.shape[1])
+        layers, mask = left_pad(layers, mask, length)
+        new_layers, new_mask = left_pad(new_layers, new_mask.to(mask.device), length)
+        layers = tuple(
+            tuple(torch.cat([old, new.to(old.device)]) for old, new in zip(layer, new_layer))
+            for layer, new_layer in zip(layers, new_layers)
+        )
+        return layers, torch.cat([mask, new_mask])
+
+    def stats(self):
+        return {"prefill_tokens": self.prefill_tokens, "reused_prefix_tokens": self.reused_prefix_tokens}
+
+    def run(self):
+        active, layers, mask = [], None, None
+        while True:
+            # Wait for work when idle, otherwise admit whatever has arrived
+            admitted = []
+            if not active:
+                admitted.append(self.pending.get())
+            while len(active) + len(admitted) < self.max_batch_size:
+                try:
+                    admitted.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with torch.no_grad():
+                    groups = {}
+                    for request in admitted:
+                        groups.setdefault(request.prefix, []).append(request)
+                    for group in groups.values():
+                        logits, new_layers, new_mask = self.prefill(group)
+                        for request, token in zip(group, self.sample(logits, group)):
+                            request.tokens.append(token)
+                            self.emit(request)
+                        layers, mask = self.merge(layers, mask, new_layers, new_mask)
+                        active += group
+
+                    # Every active request has one sampled token not yet in the cache
+                    unfinished = [row for row, request in enumerate(active) if not self.finished(request)]
+                    if len(unfinished) < len(active):
+                        active, layers, mask = self.release(active, layers, mask, unfinished)
+                    if not active:
+                        continue
+
+                    input_ids = torch.tensor([[request.tokens[-1]] for request in active], dtype=torch.long)
+                    position_ids = mask.sum(dim=1, keepdim=True)
+                    mask = torch.cat([mask, torch.ones((len(active), 1), dtype=mask.dtype)], dim=1)
+                    logits, layers = self.forward(input_ids, mask, position_ids, layers)
+                    for request, token in zip(active, self.sample(logits, active)):
+                        request.tokens.append(token)
+                        self.emit(request)
+            except Exception as e:
+                print(f"Error in generation scheduler: {str(e)}")
+                for request in active + admitted:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                active, layers, mask = [], None, None
+
+    def finished(self, request):
+        return request.cancelled or request.tokens[-1] == self.tokenizer.eos_token_id or len(request.tokens) >= request.max_new_tokens
+
+    def release(self, active, layers, mask, keep):
+        for row, request in enumerate(active):
+            if row not in keep:
+                request.future.set_result(self.tokenizer.decode(request.tokens, skip_special_tokens=True))
+        if not keep:
+            return [], None, None
+
+        rows = torch.tensor(keep, dtype=torch.long)
+        mask = mask[rows]
+        # Drop padding columns no remaining request needs
+        start = int(mask.any(dim=0).nonzero()[0])
+        mask = mask[:, start:]
+        layers = tuple(
+            tuple(tensor[rows.to(tensor.device), :, start:] for tensor in layer)
+            for layer in layers
+        )
+        return [active[row] for row in keep], layers, mask
+
+class CachedAnswer:
+    def __init__(self, vector, context, index_version, answer, seconds):
+        self.vector = vector
+        self.context = context
+        self.index_version = index_version
+        self.answer = answer
+        self.seconds = seconds
+        self.created = time.monotonic()
+        self.size = vector.nbytes + len(answer.encode("utf-8")) + len(context.encode("utf-8"))
+
+class SemanticAnswerCache:
+    # Answers keyed by the embedding of the question. A new question reuses
+    # an answer when its cosine similarity reaches the threshold, the earlier
+    # conversation, parsed filters and named products are the same, and the
+    # index has not changed since. Entries
+    # are evicted least recently used first, and when they expire.
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL,
+                 max_entries=SEMANTIC_CACHE_ENTRIES, max_bytes=int(SEMANTIC_CACHE_MB * 1024 * 1024)):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.bytes = 0
+        self.matrix = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def context_key(chat_history, scope=None):
+        # format_query only includes the last three exchanges. scope holds
+        # what steers retrieval besides the embedding, which barely differs
+        # between "under $300" and "under $500" or "iPhone 14" and "iPhone 15"
+        return json.dumps([chat_history[-3:], scope], sort_keys=True)
+
+    def discard(self, entry_id):
+        self.bytes -= self.entries.pop(entry_id).size
+        self.matrix = None
+
+    def get(self, vector, context, index_version):
+        with self.lock:
+            now = time.monotonic()
+            for entry_id in [entry_id for entry_id, entry in self.entries.items()
+                             if now - entry.created > self.ttl or entry.index_version != index_version]:
+                self.discard(entry_id)
+
+            best = None
+            if self.entries:
+                if self.matrix is None:
+                    self.matrix = (list(self.entries), np.stack([entry.vector for entry in self.entries.values()]))
+                entry_ids, vectors = self.matrix
+                similarities = vectors @ vector
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    if self.entries[entry_ids[position]].context == context:
+                        best = entry_ids[position]
+                        break
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            entry = self.entries[best]
+            self.hits += 1
+            self.saved_seconds += entry.seconds
+            return entry.answer
+
+    def put(self, vector, context, index_version, answer, seconds):
+        entry = CachedAnswer(vector, context, index_version, answer, seconds)
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            self.entries[self.next_id] = entry
+            self.next_id += 1
+            self.bytes += entry.size
+            self.matrix = None
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_generation_seconds": self.saved_seconds,
+            }
+
+class PreparedAnswer:
+    # Result of the retrieval phase: either a finished answer (from the
+    # aggregates or the answer cache) or the prompt to generate from
+    def __init__(self, answer=None, prompt=None, documents=(), cache_key=None, start=None):
+        self.answer = answer
+        self.prompt = prompt
+        self.documents = documents
+        self.cache_key = cache_key
+        self.start = start
+
+class SessionStore:
+    # Conversation history per session ID. A session keeps its latest
+    # max_turns turns within max_session_bytes of text, sessions idle for
+    # idle_seconds are dropped, and when all sessions together pass
+    # max_bytes the least recently used ones are evicted first.
+
+    def __init__(self, max_turns=SESSION_TURNS, max_session_kb=SESSION_KB,
+                 idle_seconds=SESSION_IDLE_SECONDS, max_mb=SESSION_STORE_MB):
+        self.max_turns = max_turns
+        self.max_session_bytes = int(max_session_kb * 1024)
+        self.idle_seconds = idle_seconds
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        # session ID -> {"turns", "bytes", "last_used"}, least recently used first
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @staticmethod
+    def turn_bytes(message, answer):
+        return len(message.encode("utf-8")) + len(answer.encode("utf-8"))
+
+    def drop(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.bytes -= session["bytes"]
+        return session
+
+    def expire(self, now):
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session["last_used"] < self.idle_seconds:
+                break
+            self.drop(session_id)
+            self.evictions += 1
+
+    def history(self, session_id):
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            session["last_used"] = now
+            self.sessions.move_to_end(session_id)
+            return list(session["turns"])
+
+    def append(self, session_id, message, answer):
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = {"turns": [], "bytes": 0, "last_used": now}
+            session["turns"].append((message, answer))
+            size = self.turn_bytes(message, answer)
+            session["bytes"] += size
+            self.bytes += size
+
+            # The newest turn is always kept, even if it alone is over the cap
+            while len(session["turns"]) > 1 and (
+                len(session["turns"]) > self.max_turns or session["bytes"] > self.max_session_bytes
+            ):
+                size = self.turn_bytes(*session["turns"].pop(0))
+                session["bytes"] -= size
+                self.bytes -= size
+
+            session["last_used"] = now
+            self.sessions.move_to_end(session_id)
+            while self.bytes > self.max_bytes and len(self.sessions) > 1:
+                self.drop(next(iter(self.sessions)))
+                self.evictions += 1
+
+    def clear(self, session_id):
+        with self.lock:
+            self.drop(session_id)
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.bytes, "evictions": self.evictions}
+
+class AnswerFilter:
+    # Trims a streamed answer as it grows: a leading "Helpful Answer:" is
+    # dropped, and the answer ends where the model starts another
+    # "Helpful Answer:" or an "Unhelpful" section. Text that could still turn
+    # into one of those markers is held back until it is resolved.
+
+    START = "Helpful Answer:"
+    STOPS = ("Helpful Answer:", "Unhelpful")
+
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self.emitted = 0
+        self.done = False
+
+    def feed(self, piece):
+        if self.done:
+            return ""
+        self.text += piece
+
+        if self.start is None:
+            head = self.text.lstrip()
+            if not head or self.START.startswith(head):
+                return ""
+            start = len(self.text) - len(head)
+            if head.startswith(self.START):
+                rest = head[len(self.START):]
+                if not rest.strip():
+                    return ""
+                start += len(self.START) + len(rest) - len(rest.lstrip())
+            self.start = start
+
+        body = self.text[self.start:]
+        stops = [index for index in (body.find(stop) for stop in self.STOPS) if index >= 0]
+        if stops:
+            end = min(stops)
+            self.done = True
+        else:
+            held = max(
+                (size for stop in self.STOPS for size in range(1, len(stop)) if body.endswith(stop[:size])),
+                default=0
+            )
+            end = len(body) - held
+
+        # Trailing whitespace waits too, in case the answer ends there
+        end = len(body[:end].rstrip())
+        visible = body[self.emitted:end]
+        self.emitted = max(self.emitted, end)
+        return visible
+
+    def finish(self):
+        # Generation ended, so held-back text was not a marker after all
+        if self.done or self.start is None:
+            return ""
+        self.done = True
+        visible = self.text[self.start:][self.emitted:].rstrip()
+        self.emitted = len(self.text) - self.start
+        return visible
+
+class LlamaCppGenerator:
+    # GGUF model run by llama.cpp on CPU. llama.cpp keeps the KV cache of the
+    # previous prompt and only evaluates what follows the common prefix, so
+    # QA_PROMPT_PREFIX is not recomputed between requests. The model is not
+    # thread-safe, so requests take turns.
+
+    def __init__(self, max_length, temperature=0.7, top_p=0.95, repetition_penalty=1.15,
+                 repo_id=LLAMA_CPP_REPO, filename=LLAMA_CPP_FILE, threads=LLM_THREADS):
+        from llama_cpp import Llama
+
+        self.llm = Llama.from_pretrained(
+            repo_id=repo_id,
+            filename=filename,
+            n_ctx=LLAMA_CPP_CONTEXT,
+            n_threads=threads,
+            verbose=False
+        )
+        self.max_length = max_length
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.lock = threading.Lock()
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def stream(self, prompt, prefix=None, max_new_tokens=None):
+        with self.lock:
+            prompt_length = len(self.llm.tokenize(prompt.encode("utf-8")))
+            limit = self.max_length - prompt_length
+            if max_new_tokens is not None:
+                limit = min(limit, max_new_tokens)
+            completion = self.llm.create_completion(
+                prompt,
+                max_tokens=max(1, limit),
+                temperature=self.temperature,
+                top_p=self.top_p,
+                repeat_penalty=self.repetition_penalty,
+                stream=True
+            )
+            try:
+                for chunk in completion:
+                    piece = chunk["choices"][0]["text"]
+                    if piece:
+                        yield piece
+            finally:
+                completion.close()
+
+    def generate(self, prompt, prefix=None, max_new_tokens=None):
+        return "".join(self.stream(prompt, prefix, max_new_tokens))
+
+    def stats(self):
+        return {}
+
+class CTranslate2Generator:
+    # int8 model run by CTranslate2 on CPU. The shared prefix is passed as
+    # the static prompt, whose KV cache CTranslate2 computes once and reuses.
+    # The converted model is created on first use if it does not exist yet.
+
+    def __init__(self, max_length, temperature=0.7, top_p=0.95, repetition_penalty=1.15,
+                 model_dir=CT2_MODEL_DIR, threads=LLM_THREADS):
+        import ctranslate2
+
+        token = os.environ.get("HF_TOKEN")
+        if not os.path.exists(os.path.join(model_dir, "model.bin")):
+            print(f"Converting {LLM_MODEL} to CTranslate2 int8 in {model_dir}...")
+            ctranslate2.converters.TransformersConverter(LLM_MODEL, load_as_float16=True).convert(
+                model_dir, quantization="int8", force=True
+            )
+
+        self.generator = ctranslate2.Generator(model_dir, device="cpu", compute_type="int8", intra_threads=threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL, token=token)
+        self.max_length = max_length
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.static_prompts = {}
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def tokens(self, text, special):
+        return self.tokenizer.convert_ids_to_tokens(self.tokenizer(text, add_special_tokens=special).input_ids)
+
+    def stream(self, prompt, prefix=None, max_new_tokens=None):
+        static_prompt = None
+        if prefix and len(prompt) > len(prefix) and prompt.startswith(prefix):
+            if prefix not in self.static_prompts:
+                self.static_prompts[prefix] = self.tokens(prefix, special=True)
+            static_prompt = self.static_prompts[prefix]
+            prompt_tokens = self.tokens(prompt[len(prefix):], special=False)
+        else:
+            prompt_tokens = self.tokens(prompt, special=True)
+        prompt_length = len(prompt_tokens) + len(static_prompt or [])
+        limit = self.max_length - prompt_length
+        if max_new_tokens is not None:
+            limit = min(limit, max_new_tokens)
+
+        ids, text = [], ""
+        for step in self.generator.generate_tokens(
+            prompt_tokens,
+            max_length=max(1, limit),
+            # The default of 1024 would cut longer prompts; max_length
+            # already bounds them
+            max_input_length=0,
+            sampling_topk=0,
+            sampling_topp=self.top_p,
+            sampling_temperature=self.temperature,
+            repetition_penalty=self.repetition_penalty,
+            static_prompt=static_prompt
+        ):
+            ids.append(step.token_id)
+            decoded = self.tokenizer.decode(ids, skip_special_tokens=True)
+            # Wait until a character split over several tokens is complete
+            if decoded.endswith("\ufffd"):
+                continue
+            piece, text = decoded[len(text):], decoded
+            if piece:
+                yield piece
+
+    def generate(self, prompt, prefix=None, max_new_tokens=None):
+        return "".join(self.stream(prompt, prefix, max_new_tokens))
+
+    def stats(self):
+        return {}
+
+class BestBuyRAGChat:
+    def __init__(self,
+                 document_template=DOCUMENT_TEMPLATE,
+                 product_template=PRODUCT_TEMPLATE,
+                 review_template=REVIEW_TEMPLATE,
+                 index_layout=INDEX_LAYOUT,
+                 shard_by=SHARD_BY,
+                 embedding_cache_path=EMBEDDING_CACHE_PATH,
+                 embedding_workers=EMBEDDING_WORKERS,
+                 embedding_threads=EMBEDDING_THREADS,
+                 product_candidates=PRODUCT_CANDIDATES,
+                 product_match_distance=PRODUCT_MATCH_DISTANCE,
+                 query_filters=QUERY_FILTERS,
+                 hybrid_search=HYBRID_SEARCH,
+                 aggregate_routing=AGGREGATE_ROUTING,
+                 rerank=RERANK,
+                 diversity=DIVERSITY,
+                 streaming_ingest=STREAMING_INGEST,
+                 ingest_batch_size=INGEST_BATCH_SIZE,
+                 ingest_memory_limit_mb=INGEST_MEMORY_LIMIT_MB,
+                 index_type=FAISS_INDEX_TYPE,
+                 nlist=FAISS_NLIST,
+                 nprobe=FAISS_NPROBE,
+                 hnsw_m=FAISS_HNSW_M,
+                 ef_search=FAISS_EF_SEARCH,
+                 retrieval_workers=1,
+                 generation_batch_size=GENERATION_BATCH_SIZE,
+                 max_length=MAX_LENGTH,
+                 answer_tokens=ANSWER_TOKENS,
+                 llm_backend=LLM_BACKEND,
+                 context_packing=CONTEXT_PACKING,
+                 semantic_cache=SEMANTIC_CACHE):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        if index_layout not in INDEX_LAYOUTS:
+            raise ValueError(f"Unknown index layout {index_layout!r}, expected one of {INDEX_LAYOUTS}")
+        if shard_by not in SHARD_MODES:
+            raise ValueError(f"Unknown shard mode {shard_by!r}, expected one of {SHARD_MODES}")
+        if diversity not in DIVERSITY_MODES:
+            raise ValueError(f"Unknown diversity mode {diversity!r}, expected one of {DIVERSITY_MODES}")
+        if llm_backend not in LLM_BACKENDS:
+            raise ValueError(f"Unknown LLM backend {llm_backend!r}, expected one of {LLM_BACKENDS}")
+
+        self.document_template = document_template
+        self.product_template = product_template
+        self.review_template = review_template
+        self.index_layout = index_layout
+        self.shard_by = shard_by
+        # Searches the shards of a sharded review index in parallel
+        self.shard_pool = ThreadPoolExecutor(max_workers=SHARD_WORKERS) if shard_by != "off" else None
+        self.embedding_workers = embedding_workers
+        self.embedding_threads = embedding_threads
+        self.embedding_cache = EmbeddingCache(embedding_cache_path, EMBEDDING_MODEL) if embedding_cache_path else None
+        self.product_candidates = product_candidates
+        self.product_match_distance = product_match_distance
+        self.query_filters = query_filters
+        self.hybrid_search = hybrid_search
+        self.aggregate_routing = aggregate_routing
+        self.reranker = Reranker() if rerank else None
+        self.diversity = diversity
+        self.streaming_ingest = streaming_ingest
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_memory_limit_mb = ingest_memory_limit_mb
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        # Questions retrieved at once; the command line asks one at a time
+        self.retrieval_workers = retrieval_workers
+        self.generation_batch_size = generation_batch_size
+        self.max_length = max_length
+        self.answer_tokens = answer_tokens
+        self.llm_backend = llm_backend
+        self.context_packing = context_packing
+        # The LLM's tokenizer, loaded on first use to count prompt tokens
+        self.tokenizer = None
+        self.packer = None
+        self.scheduler = None
+        self.answer_cache = SemanticAnswerCache() if semantic_cache else None
+        # Bumped by every upsert or delete, so cached answers are not served
+        # from before the change
+        self.index_generation = 0
+        self.embeddings = None
+        self.vectorstore = None
+        # Created for the loaded index's embedding model on first use
+        self.query_encoder = None
+        self.encoder_lock = threading.Lock()
+        self.product_vectorstore = None
+        self.chunk_table = ChunkTable()
+        self.lexical_index = LexicalIndex()
+        self.aggregates = ProductAggregates()
+        # Runs the lexical search while the query is embedded and searched,
+        # one for each question being retrieved
+        self.search_pool = ThreadPoolExecutor(max_workers=retrieval_workers)
+        # Held for reading by retrieval and for writing by upserts and deletes,
+        # which change the index, docstore, chunk table and aggregates in place
+        self.index_lock = ReadWriteLock()
+        # Serializes snapshot writes, which share a temporary directory
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_path = None
+        self.index_read_only = False
+        self.manifest = None
+        self.products_df = None
+        self.sessions = SessionStore()
+        # Startup progress; requests are served once ready is set
+        self.stages = {stage: False for stage in INIT_STAGES}
+        self.init_error = None
+        self.ready = threading.Event()
+        self.init_lock = threading.Lock()
+        self.init_thread = None
+
+    def prepare_data(self, revisions=None):
+        revisions = revisions or {}
+        try:
+            # Load both datasets, pinned to the revision the index is keyed on
+            reviews_dataset = load_dataset(
+                REVIEWS_DATASET,
+                revision=revisions.get(REVIEWS_DATASET),
+                token=os.environ.get("HF_TOKEN"),
+                use_auth_token=True,
+                trust_remote_code=True
+            )
+
+            products_dataset = load_dataset(
+                PRODUCTS_DATASET,
+                revision=revisions.get(PRODUCTS_DATASET),
+                token=os.environ.get("HF_TOKEN"),
+                use_auth_token=True,
+                trust_remote_code=True
+            )
+
+            # Convert to pandas DataFrames
+            reviews_df = reviews_dataset['train'].to_pandas()
+            products_df = products_dataset['train'].to_pandas()
+
+            # Merge datasets on product name
+            merged_df = self.merge_products(reviews_df, products_df)
+
+            # Kept for upserts, which join new reviews against the same products
+            self.products_df = products_df
+
+            return merged_df
+        except Exception as e:
+            print(f"Error loading datasets: {str(e)}")
+            return None
+
+    def merge_products(self, reviews_df, products_df):
+        return pd.merge(
+            reviews_df,
+            products_df[['name', 'price', 'brand', 'category']],
+            left_on='product_name',
+            right_on='name',
+            how='left'
+        )
+
+    def documents_from_frame(self, merged_df):
+        merged_df = merged_df.assign(review_id=review_ids(merged_df))
+        merged_df = merged_df.drop_duplicates('review_id', keep='last')
+
+        template = self.review_template if self.index_layout == "hierarchical" else self.document_template
+        documents = build_combined_text(merged_df, template).tolist()
+
+        # Typed copies of the fields the retriever can filter on
+        prices = price_values(merged_df['price']).astype(object).where(lambda column: column.notna(), None)
+        ratings = pd.to_numeric(merged_df['rating'], errors='coerce').astype(object).where(lambda column: column.notna(), None)
+        brands = merged_df['brand'].astype(object).where(merged_df['brand'].notna(), None)
+        categories = merged_df['category'].astype(object).where(merged_df['category'].notna(), None)
+        verified = flag_values(merged_df['verified_purchase'])
+        models = merged_df['product_model'].astype(object).where(merged_df['product_model'].notna(), None)
+
+        metadatas = [
+            {
+                "review_id": review_id,
+                "product_id": product_id(product_name),
+                "product_name": product_name,
+                "product_model": product_model,
+                "price": price,
+                "brand": brand,
+                "category": category,
+                "rating": rating,
+                "verified_purchase": bool(is_verified),
+            }
+            for review_id, product_name, product_model, price, brand, category, rating, is_verified in zip(
+                merged_df['review_id'], merged_df['product_name'], models, prices, brands, categories, ratings, verified
+            )
+        ]
+        return documents, metadatas
+
+    def product_documents(self, merged_df):
+        products = merged_df[merged_df['product_name'].notna()]
+        products = products.drop_duplicates('product_name', keep='last')
+        texts = build_combined_text(products, self.product_template).tolist()
+        return [
+            Document(
+                page_content=text,
+                metadata={
+                    "product_id": product_id(name),
+                    "product_name": name,
+                    "chunk_id": product_id(name),
+                    "n_tokens": n_tokens,
+                }
+            )
+            for text, name, n_tokens in zip(texts, products['product_name'], self.token_counts(texts))
+        ]
+
+    def format_query(self, query, chat_history):
+        # The fixed instructions live in QA_PROMPT_PREFIX. Earlier exchanges
+        # are dropped, oldest first, until they fit in half of what the
+        # question and the answer leave, so retrieved reviews keep the rest
+        exchanges = [f"User: {q}\nAssistant: {a}" for q, a in chat_history[-3:]]
+        if exchanges:
+            prompt = QA_PROMPT.format(context="", question=self.format_query(query, []))
+            budget = (self.max_length - self.token_counts([prompt])[0] - self.answer_tokens) // 2
+            counts = self.token_counts(exchanges)
+            # One more token per exchange for the newline joining them
+            while exchanges and sum(counts) + len(counts) > budget:
+                exchanges.pop(0)
+                counts.pop(0)
+        context = "\n".join(exchanges)
+        return f"""Previous conversation:
+{context}
+
+Question: {query}"""
+
+    def retrieval_query(self, message, chat_history):
+        # Retrieval sees the question alone, not the prompt's instructions
+        # or earlier answers. A follow-up such as "how is its battery?" gets
+        # the product named earlier in the conversation appended.
+        text = message.lower()
+        if not REFERENCE_PATTERN.search(text) or self.aggregates.match(text):
+            return message
+        for question, _ in reversed(chat_history[-3:]):
+            products = self.aggregates.match(question.lower())
+            if products:
+                names = sorted(self.aggregates.products[pid]["name"] for pid in products)[:3]
+                return f"{message} ({'; '.join(names)})"
+        return message
+
+    def retrieve_context(self, search_query, question):
+        # search_query is embedded and searched; question is what the prompt
+        # will hold, which the token budget has to leave room for
+        if self.context_packing and self.scheduler is not None:
+            return self.retrieve_packed(search_query, question=question)
+        return self.retrieve(search_query)
+
+    def build_prompt(self, query, documents):
+        context = DOCUMENT_SEPARATOR.join(document.page_content for document in documents)
+        return QA_PROMPT.format(context=context, question=query)
+
+    def answer_aggregate(self, message):
+        # Counts, averages and prices are read from the aggregates rather than
+        # guessed by the LLM from a few retrieved chunks
+        if not self.aggregate_routing:
+            return None
+        return self.aggregates.answer(message)
+
+    def prepare_answer(self, message, chat_history):
+        # Everything before generation: routing, the answer cache, query
+        # embedding and retrieval
+        with self.index_lock.reading():
+            answer = self.answer_aggregate(message)
+            if answer is not None:
+                return PreparedAnswer(answer=answer)
+
+            cache_key = None
+            if self.answer_cache is not None:
+                vector = self.encode_query(message)
+                scope = {
+                    "filters": self.parse_filters(message) if self.query_filters else {},
+                    "products": sorted(self.aggregates.match(message.lower())),
+                }
+                cache_key = (
+                    vector / max(np.linalg.norm(vector), 1e-12),
+                    SemanticAnswerCache.context_key(chat_history, scope),
+                    self.index_version()
+                )
+                answer = self.answer_cache.get(*cache_key)
+                if answer is not None:
+                    return PreparedAnswer(answer=answer)
+
+            start = time.perf_counter()
+            formatted_query = self.format_query(message, chat_history)
+            documents = self.retrieve_context(self.retrieval_query(message, chat_history), formatted_query)
+            return PreparedAnswer(
+                prompt=self.build_prompt(formatted_query, documents),
+                documents=documents,
+                cache_key=cache_key,
+                start=start
+            )
+
+    def generate_answer(self, prepared):
+        if prepared.answer is not None:
+            yield prepared.answer
+            return
+
+        answer = ""
+        answer_filter = AnswerFilter()
+        pieces = self.scheduler.stream(prepared.prompt, QA_PROMPT_PREFIX, self.answer_tokens)
+        try:
+            for piece in pieces:
+                visible = answer_filter.feed(piece)
+                if visible:
+                    answer += visible
+                    yield visible
+                if answer_filter.done:
+                    break
+        finally:
+            pieces.close()
+        rest = answer_filter.finish()
+        answer += rest
+        yield rest
+
+        if prepared.documents:
+            sources = "\n\nBased on reviews and product information from multiple sources."
+            answer += sources
+            yield sources
+
+        if prepared.cache_key is not None:
+            self.answer_cache.put(*prepared.cache_key, answer, time.perf_counter() - prepared.start)
+
+    def stream_answer(self, message, chat_history):
+        # Retrieval runs first, then the answer is yielded piece by piece
+        yield from self.generate_answer(self.prepare_answer(message, chat_history))
+
+    def initialize_system(self):
+        # Runs once per process; later calls return as soon as it is done
+        with self.init_lock:
+            if self.ready.is_set():
+                return
+            try:
+                print("Initializing RAG system...")
+                # Reuses the on-disk snapshot when the data and settings are unchanged
+                self.load_or_build_index()
+                self.stages["index"] = True
+                self.setup_llm()
+                self.stages["llm"] = True
+
+                self.warm_up()
+                self.stages["warmup"] = True
+                self.init_error = None
+                self.ready.set()
+            except Exception as e:
+                self.init_error = str(e)
+                raise
+        print("System initialized and ready!")
+
+    def warm_up(self):
+        # One retrieval and a few generated tokens load the embedding model,
+        # allocate the LLM's buffers and cache the KV of QA_PROMPT_PREFIX
+        # before the first user arrives
+        start = time.perf_counter()
+        question = self.format_query(WARMUP_QUESTION, [])
+        documents = self.retrieve_context(WARMUP_QUESTION, question)
+        pieces = self.scheduler.stream(self.build_prompt(question, documents), QA_PROMPT_PREFIX)
+        try:
+            for _ in zip(range(WARMUP_TOKENS), pieces):
+                pass
+        finally:
+            pieces.close()
+        print(f"Warm-up took {time.perf_counter() - start:.1f}s")
+
+    def not_ready_message(self):
+        if self.init_error is not None:
+            return f"System failed to initialize: {self.init_error}"
+        return "System is still initializing. Please wait a moment and try again."
+
+    def start_initialization(self):
+        # Page loads must not rebuild anything, so the index and model are
+        # loaded once, in the background, when the process starts
+        with self.init_lock:
+            if self.init_thread is None:
+                self.init_thread = threading.Thread(target=self.initialize_in_background, daemon=True)
+                self.init_thread.start()
+
+    def initialize_in_background(self):
+        try:
+            self.initialize_system()
+        except Exception as e:
+            print(f"Error initializing system: {str(e)}")
+
+    def health(self):
+        status = {
+            "ready": self.ready.is_set(),
+            "stages": dict(self.stages),
+            "error": self.init_error,
+            "sessions": self.sessions.stats(),
+        }
+        if self.scheduler is not None:
+            status["generation"] = self.scheduler.stats()
+        if self.answer_cache is not None:
+            status["answer_cache"] = self.answer_cache.stats()
+        if self.reranker is not None:
+            status["reranker"] = self.reranker.stats()
+        if self.query_encoder is not None:
+            status["query_encoder"] = self.query_encoder.stats()
+        if self.vectorstore is not None and isinstance(self.vectorstore.index, ShardedIndex):
+            status["shards"] = {key: shard.ntotal for key, shard in self.vectorstore.index.shards.items()}
+        return status
+
+    def setup_llm(self):
+        try:
+            # CPU runtimes load a quantized model of their own
+            if self.llm_backend == "llama_cpp":
+                print("Loading GGUF model with llama.cpp...")
+                self.scheduler = LlamaCppGenerator(max_length=self.max_length)
+                return self.scheduler
+            if self.llm_backend == "ctranslate2":
+                print("Loading int8 model with CTranslate2...")
+                self.scheduler = CTranslate2Generator(max_length=self.max_length)
+                return self.scheduler
+
+            # First check if we have the token
+            token = os.environ.get("HF_TOKEN")
+            if not token:
+                raise ValueError("HF_TOKEN environment variable is not set")
+
+            print("Loading model and tokenizer...")
+            # Load model with explicit configurations
+            model = AutoModelForCausalLM.from_pretrained(
+                LLM_MODEL,
+                use_auth_token=token,
+                torch_dtype=torch.float16,
+                load_in_4bit=True,
+                device_map="auto"
+            )
+
+            tokenizer = AutoTokenizer.from_pretrained(
+                LLM_MODEL,
+                use_auth_token=token
+            )
+
+            print("Creating generation scheduler...")
+            # Concurrent chat requests are batched into shared forward passes,
+            # sampling as the text-generation pipeline did
+            self.scheduler = GenerationScheduler(
+                model,
+                tokenizer,
+                max_length=self.max_length,
+                max_batch_size=self.generation_batch_size,
+                temperature=0.7,
+                top_p=0.95,
+                repetition_penalty=1.15
+            )
+            return self.scheduler
+        except Exception as e:
+            print(f"Critical error in setup_llm: {str(e)}")
+            raise
+
+    def create_embeddings(self):
+        if self.embeddings is None:
+            self.embeddings = EmbeddingEngine(EMBEDDING_MODEL, self.embedding_workers, self.embedding_threads)
+        return self.embeddings
+
+    def create_index(self, vectors, index_type=None):
+        # Every index type takes explicit labels, so chunks keep a stable ID
+        # and can be removed individually
+        index_type = index_type or self.index_type
+        dimension = vectors.shape[1]
+        if index_type == "ivf":
+            nlist = self.ivf_lists(len(vectors))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
+            sample_size = min(len(vectors), nlist * 256)
+            sample = vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)]
+            index.train(sample)
+            # Lets vectors be reconstructed (and removed) by label
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif index_type == "hnsw":
+            index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(dimension, self.hnsw_m))
+        else:
+            index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+        self.apply_search_params(index)
+        return index
+
+    def ivf_lists(self, num_vectors):
+        # Fewer lists on small corpora, FAISS wants ~39 training points per list
+        return max(1, min(self.nlist, num_vectors // 39))
+
+    def grow_ivf(self, index, final=False):
+        # An IVF index is trained on the vectors it is created with: the first
+        # streaming batch, or the few chunks an upsert puts in a new shard.
+        # Once it holds enough vectors for twice as many lists (or for any
+        # more, when ingestion has ended) it is retrained on all of them, up
+        # to nlist; the vectors are read back from the index, so nothing is
+        # re-embedded.
+        if not isinstance(index, faiss.IndexIVF):
+            return index
+        nlist = self.ivf_lists(index.ntotal)
+        if nlist <= index.nlist or (nlist < 2 * index.nlist and not final):
+            return index
+        labels = ivf_labels(index)
+        vectors = index.reconstruct_batch(labels)
+        rebuilt = self.create_index(vectors, "ivf")
+        rebuilt.add_with_ids(vectors, labels)
+        return rebuilt
+
+    def apply_search_params(self, index):
+        if isinstance(index, faiss.IndexIDMap2):
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+        elif isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.ef_search
+
+    def embed_texts(self, embeddings, texts):
+        if self.embedding_cache is not None and texts:
+            return self.embedding_cache.embed(embeddings, [text.page_content for text in texts])
+        vectors = embeddings.embed_documents([text.page_content for text in texts])
+        return np.asarray(vectors, dtype=np.float32)
+
+    def create_vectorstore(self, texts, embeddings=None, index_type=None, shard_by="off"):
+        embeddings = embeddings or self.create_embeddings()
+        vectors = self.embed_texts(embeddings, texts)
+        if shard_by != "off":
+            # Shards are created as add_to_vectorstore meets their first chunks
+            index = ShardedIndex(shard_by, pool=self.shard_pool)
+        else:
+            index = self.create_index(vectors, index_type)
+        vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+        self.add_to_vectorstore(vectorstore, texts, vectors)
+        return vectorstore
+
+    def add_to_vectorstore(self, vectorstore, texts, vectors=None):
+        if vectors is None:
+            vectors = self.embed_texts(vectorstore.embedding_function, texts)
+
+        chunk_ids = [text.metadata["chunk_id"] for text in texts]
+        labels = np.array([faiss_id(chunk_id) for chunk_id in chunk_ids], dtype=np.int64)
+        if isinstance(vectorstore.index, ShardedIndex):
+            shards = vectorstore.index.shards
+            keys = np.array([vectorstore.index.key(text.metadata) for text in texts])
+            for key in set(keys.tolist()):
+                in_shard = keys == key
+                if key not in shards:
+                    shards[key] = self.create_index(vectors[in_shard])
+                shards[key].add_with_ids(vectors[in_shard], labels[in_shard])
+                shards[key] = self.grow_ivf(shards[key])
+        else:
+            vectorstore.index.add_with_ids(vectors, labels)
+            vectorstore.index = self.grow_ivf(vectorstore.index)
+        vectorstore.docstore.add(dict(zip(chunk_ids, texts)))
+        vectorstore.index_to_docstore_id.update(zip(labels.tolist(), chunk_ids))
+
+    def remove_from_index(self, index, labels):
+        try:
+            index.remove_ids(labels)
+            return index
+        except RuntimeError:
+            # HNSW graphs cannot drop nodes; rebuild the graph from the stored
+            # vectors, which costs no re-embedding
+            all_labels = faiss.vector_to_array(index.id_map)
+            keep = ~np.isin(all_labels, labels)
+            vectors = index.index.reconstruct_n(0, index.ntotal)[keep]
+            rebuilt = self.create_index(vectors, "hnsw")
+            rebuilt.add_with_ids(vectors, all_labels[keep])
+            return rebuilt
+
+    def remove_from_vectorstore(self, vectorstore, chunk_ids):
+        labels = np.array([faiss_id(chunk_id) for chunk_id in chunk_ids], dtype=np.int64)
+        if isinstance(vectorstore.index, ShardedIndex):
+            shards = vectorstore.index.shards
+            keys = np.array([vectorstore.index.key(vectorstore.docstore.search(chunk_id).metadata) for chunk_id in chunk_ids])
+            for key in set(keys.tolist()):
+                shards[key] = self.remove_from_index(shards[key], labels[keys == key])
+                if shards[key].ntotal == 0:
+                    del shards[key]
+        else:
+            vectorstore.index = self.remove_from_index(vectorstore.index, labels)
+        vectorstore.docstore.delete(chunk_ids)
+        for label in labels.tolist():
+            del vectorstore.index_to_docstore_id[label]
+
+    def split_documents(self, documents, metadatas=None):
+        if metadatas is None:
+            metadatas = [
+                {"review_id": hashlib.sha1(document.encode("utf-8")).hexdigest()[:16]}
+                for document in documents
+            ]
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=len,
+            add_start_index=True
+        )
+        texts = text_splitter.create_documents(documents, metadatas=metadatas)
+
+        # Chunks of a review are numbered from 0, which is what lets a review's
+        # chunks be found again from its ID alone when it is updated or deleted
+        chunk_counts = {}
+        previous = None
+        for text in texts:
+            review_id = text.metadata["review_id"]
+            text.metadata["chunk_id"] = f"{review_id}:{chunk_counts.get(review_id, 0)}"
+            chunk_counts[review_id] = chunk_counts.get(review_id, 0) + 1
+            # Characters shared with the previous chunk of the same review
+            overlap = 0
+            if previous is not None and previous.metadata["review_id"] == review_id:
+                end = previous.metadata["start_index"] + len(previous.page_content)
+                overlap = max(0, min(end - text.metadata["start_index"], len(text.page_content)))
+            text.metadata["overlap"] = overlap
+            previous = text
+
+        # Prompt tokens of each chunk, whole and without the overlap, for the
+        # context packer
+        counts = self.token_counts([text.page_content for text in texts])
+        tails = self.token_counts([text.page_content[text.metadata["overlap"]:] for text in texts])
+        for text, n_tokens, tail_tokens in zip(texts, counts, tails):
+            text.metadata["n_tokens"] = n_tokens
+            text.metadata["tail_tokens"] = tail_tokens
+        return texts
+
+    def token_counts(self, texts):
+        # Counted with the LLM's tokenizer; llama.cpp's GGUF uses the same vocabulary
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL, token=os.environ.get("HF_TOKEN"))
+        counts = []
+        for start in range(0, len(texts), TOKEN_COUNT_BATCH_SIZE):
+            batch = list(texts[start:start + TOKEN_COUNT_BATCH_SIZE])
+            counts.extend(len(ids) for ids in self.tokenizer(batch, add_special_tokens=False).input_ids)
+        return counts
+
+    def search_params(self, index, selector):
+        # Each index family only accepts its own parameter type; the shards of
+        # a sharded index are all of one family
+        if isinstance(index, ShardedIndex):
+            index = next(iter(index.shards.values()))
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+        if isinstance(inner, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+        if isinstance(inner, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+        return faiss.SearchParameters(sel=selector)
+
+    def search_reviews(self, query_vector, k, rows=None):
+        index = self.vectorstore.index
+        found = None
+        if rows is not None:
+            if len(rows) == 0:
+                return np.empty(0, dtype=np.int64)
+            if isinstance(index, ShardedIndex):
+                # Shards holding none of the selected chunks are not searched
+                index = index.subset(self.chunk_table.values(index.shard_by, rows))
+            fraction = len(rows) / index.ntotal
+            if fraction >= FILTER_SELECTOR_FRACTION:
+                # Broad filters: over-fetch and keep the matching hits
+                fetch = min(index.ntotal, int(np.ceil(k / fraction * 2)))
+                _, candidates = index.search(query_vector, fetch)
+                candidates = candidates[0][candidates[0] != -1]
+                candidates = candidates[self.chunk_table.contains(candidates, rows)]
+                if len(candidates) >= k or fetch == index.ntotal:
+                    found = candidates[:k]
+            if found is None:
+                selector = faiss.IDSelectorBatch(self.chunk_table.columns["label"][rows])
+                _, found = index.search(query_vector, k, params=self.search_params(index, selector))
+                found = found[0]
+        else:
+            _, found = index.search(query_vector, k)
+            found = found[0]
+        return found[found != -1]
+
+    def search_lexical(self, query, k, rows=None):
+        if rows is None:
+            return self.lexical_index.search(query, k)
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+        return self.lexical_index.search(query, k, lambda labels: self.chunk_table.contains(labels, rows))
+
+    def review_documents(self, labels):
+        return [self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[label]) for label in labels]
+
+    def match_products(self, query_vector):
+        distances, found = self.product_vectorstore.index.search(query_vector, self.product_candidates)
+        return [
+            self.product_vectorstore.docstore.search(self.product_vectorstore.index_to_docstore_id[label])
+            for label, distance in zip(found[0], distances[0])
+            if label != -1 and distance <= self.product_match_distance
+        ]
+
+    def with_product_headers(self, documents):
+        if self.product_vectorstore is None:
+            return documents
+
+        # Each product header goes into the context once, ahead of its reviews
+        by_product = {}
+        for document in documents:
+            by_product.setdefault(document.metadata.get("product_id"), []).append(document)
+
+        result = []
+        for pid, product_reviews in by_product.items():
+            header = self.product_vectorstore.docstore.search(pid) if pid else None
+            if isinstance(header, Document):
+                result.append(header)
+            result.extend(product_reviews)
+        return result
+
+    def parse_filters(self, query):
+        # Structured constraints stated in the question; brands and categories
+        # are only recognised when they occur in the indexed data
+        text = query.lower()
+        filters = {}
+        for name in ChunkTable.CATEGORICAL:
+            for value in sorted(self.chunk_table.vocab[name], key=len, reverse=True):
+                if re.search(r"\b" + re.escape(value) + r"\b", text):
+                    filters[name] = value
+                    break
+
+        price_range = price_match(PRICE_RANGE_PATTERN, text)
+        if price_range:
+            low, high = sorted(price_value(price_range.group(name)) for name in ("low", "high"))
+            filters["min_price"], filters["max_price"] = low, high
+        else:
+            max_price = price_match(MAX_PRICE_PATTERN, text)
+            min_price = price_match(MIN_PRICE_PATTERN, text)
+            if max_price:
+                filters["max_price"] = price_value(max_price.group("amount"))
+            if min_price:
+                filters["min_price"] = price_value(min_price.group("amount"))
+
+        rating = RATING_PATTERN.search(text)
+        if rating:
+            bound, stars, plus, and_up = rating.groups()
+            stars = float(stars)
+            if bound in ("under", "below", "less than", "at most"):
+                filters["max_rating"] = stars
+            elif bound or plus or and_up:
+                filters["min_rating"] = stars
+            else:
+                filters["min_rating"] = filters["max_rating"] = stars
+
+        if VERIFIED_PATTERN.search(text):
+            filters["verified"] = True
+        return filters
+
+    def encode_query(self, text):
+        embeddings = self.vectorstore.embedding_function
+        if self.query_encoder is None or self.query_encoder.embeddings is not embeddings:
+            with self.encoder_lock:
+                if self.query_encoder is None or self.query_encoder.embeddings is not embeddings:
+                    self.query_encoder = QueryEncoder(embeddings)
+        return self.query_encoder.encode(text)
+
+    def retrieve(self, query, k=3, filters=None):
+        with self.index_lock.reading():
+            documents = self.retrieve_candidates(query, k, filters)
+            if self.diversity != "off":
+                documents = self.diversify(documents, k)
+            return self.with_product_headers(documents)
+
+    def retrieve_candidates(self, query, k, filters=None):
+        # Review chunks ranked best first: k of them, or more when the
+        # diversity step is to choose k out of a larger set
+        with self.index_lock.reading():
+            if filters is None:
+                filters = self.parse_filters(query) if self.query_filters else {}
+            filter_rows = self.chunk_table.select(filters)
+            if filter_rows is not None and len(filter_rows) == 0:
+                # No chunk satisfies the filters, which may have been misread from
+                # the question; search without them rather than answer with no context
+                filters, filter_rows = {}, None
+            # The reranker and the diversity step pick k out of a larger
+            # candidate set
+            final_k = k
+            if self.reranker is not None:
+                k = max(k, self.reranker.candidates())
+            if self.diversity != "off":
+                k = max(k, DIVERSITY_CANDIDATES)
+
+            # Exact terms such as model numbers are matched by BM25, which runs
+            # alongside the dense search and is not narrowed to the matched
+            # products, since those are found by embedding similarity.
+            lexical = None
+            if self.hybrid_search and len(self.lexical_index):
+                lexical = self.search_pool.submit(
+                    self.search_lexical, query, max(k, HYBRID_CANDIDATES), filter_rows
+                )
+
+            try:
+                query_vector = self.encode_query(query)[None, :]
+
+                # First pick the products the question is about, then search only
+                # their reviews; questions that name no product search every review.
+                # Brand, price, category, rating and verified filters narrow the
+                # candidate chunks further before the vector search.
+                products = None
+                if self.product_vectorstore is not None:
+                    matched = self.match_products(query_vector)
+                    if matched:
+                        products = [faiss_id(product.metadata["product_id"]) for product in matched]
+
+                rows = self.chunk_table.select(filters, products)
+                if rows is not None and len(rows) == 0 and products is not None:
+                    # None of the matched products satisfies the filters
+                    rows = filter_rows
+
+                if lexical is None:
+                    labels = self.search_reviews(query_vector, k, rows)
+                else:
+                    dense = self.search_reviews(query_vector, max(k, HYBRID_CANDIDATES), rows)
+                    labels = reciprocal_rank_fusion([dense.tolist(), lexical.result().tolist()], k)
+            finally:
+                # The lexical search reads the index too, so it must be over
+                # before the read lock is released, also when the dense
+                # search failed
+                if lexical is not None and not lexical.cancel():
+                    wait([lexical])
+
+            documents = self.review_documents(labels)
+            if self.reranker is not None:
+                documents = self.reranker.rerank(query, documents, k if self.diversity != "off" else final_k)
+            return documents
+
+    def diversify(self, documents, k, add=None):
+        # Spreads the k chunks over reviews and products, so that adjacent
+        # chunks of one long review or many reviews of one phone do not fill
+        # the context. documents are ranked best first. add, when given,
+        # places a picked chunk in the prompt and returns False if it did
+        # not fit; such chunks count towards neither the caps nor k.
+        if not documents:
+            return []
+        add = add or (lambda document: True)
+
+        relevance = similarity = None
+        if self.diversity == "mmr":
+            # Relevance is the rank the chunk arrived with, which already
+            # combines BM25, the dense search and the reranker; the stored
+            # vectors only measure how much a chunk repeats the ones picked
+            relevance = 1 - np.arange(len(documents)) / len(documents)
+            index = self.vectorstore.index
+            labels = np.array([faiss_id(document.metadata["chunk_id"]) for document in documents], dtype=np.int64)
+            if isinstance(index, ShardedIndex):
+                vectors = index.reconstruct_batch(labels, [index.key(document.metadata) for document in documents])
+            else:
+                vectors = index.reconstruct_batch(labels)
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            similarity = vectors @ vectors.T
+
+        picked, over_cap = [], []
+        per_review, per_product = {}, {}
+        remaining = list(range(len(documents)))
+        redundancy = np.zeros(len(documents))
+        while remaining and len(picked) < k:
+            if self.diversity == "mmr":
+                scores = MMR_LAMBDA * relevance[remaining] - (1 - MMR_LAMBDA) * redundancy[remaining]
+                best = remaining.pop(int(np.argmax(scores)))
+            else:
+                best = remaining.pop(0)
+            review = documents[best].metadata.get("review_id")
+            product = documents[best].metadata.get("product_id")
+            if per_review.get(review, 0) >= MAX_CHUNKS_PER_REVIEW or per_product.get(product, 0) >= MAX_CHUNKS_PER_PRODUCT:
+                over_cap.append(best)
+                continue
+            if not add(documents[best]):
+                continue
+            picked.append(best)
+            per_review[review] = per_review.get(review, 0) + 1
+            per_product[product] = per_product.get(product, 0) + 1
+            if similarity is not None:
+                redundancy = np.maximum(redundancy, similarity[best])
+
+        # Questions about a single product may have nothing else to offer;
+        # the best chunks over the caps then fill the remaining places
+        for best in over_cap:
+            if len(picked) >= k:
+                break
+            if add(documents[best]):
+                picked.append(best)
+        return [documents[i] for i in picked]
+
+    def context_budget(self, question):
+        # Tokens left for retrieved text once the rest of the prompt and the
+        # answer are accounted for
+        prompt = QA_PROMPT.format(context="", question=question)
+        return max(0, self.scheduler.max_length - self.token_counts([prompt])[0] - self.answer_tokens)
+
+    def retrieve_packed(self, query, filters=None, question=None):
+        with self.index_lock.reading():
+            if self.packer is None:
+                self.packer = ContextPacker(self.token_counts([DOCUMENT_SEPARATOR])[0])
+
+            # Over-fetch, then keep as many of the best chunks as the budget
+            # allows. The diversity caps count the chunks that fit, so they
+            # apply to the prompt rather than to the candidates.
+            reviews = self.retrieve_candidates(query, CONTEXT_CANDIDATES, filters)
+            headers = {
+                document.metadata["product_id"]: document for document in self.with_product_headers(reviews)
+                if "tail_tokens" not in document.metadata
+            }
+            packing = self.packer.start(self.context_budget(question or query), headers)
+            if self.diversity != "off":
+                self.diversify(reviews, len(reviews), packing.add)
+            else:
+                for document in reviews:
+                    packing.add(document)
+            return self.with_product_headers(packing.documents())
+
+    def index_version(self):
+        return f"{self.index_key(self.manifest) if self.manifest else None}:{self.index_generation}"
+
+    def dataset_revision(self, repo_id):
+        try:
+            return HfApi().dataset_info(repo_id, token=os.environ.get("HF_TOKEN")).sha
+        except Exception as e:
+            print(f"Could not resolve revision of {repo_id}: {str(e)}")
+            return None
+
+    def index_manifest(self):
+        # Everything that changes the embedded vectors belongs in the manifest,
+        # otherwise a stale snapshot would be served after the change.
+        return {
+            "revisions": {
+                REVIEWS_DATASET: self.dataset_revision(REVIEWS_DATASET),
+                PRODUCTS_DATASET: self.dataset_revision(PRODUCTS_DATASET),
+            },
+            "index_layout": self.index_layout,
+            "shard_by": self.shard_by,
+            "templates": hashlib.sha256(
+                (self.product_template + self.review_template if self.index_layout == "hierarchical"
+                 else self.document_template).encode("utf-8")
+            ).hexdigest(),
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "embedding_model": EMBEDDING_MODEL,
+            # Chunk token counts are stored with the index
+            "llm_tokenizer": LLM_MODEL,
+            "index_format": INDEX_FORMAT_VERSION,
+            # Search-time knobs (nprobe, efSearch) are applied after loading
+            "index_type": self.index_type,
+            "nlist": self.nlist if self.index_type == "ivf" else None,
+            "hnsw_m": self.hnsw_m if self.index_type == "hnsw" else None,
+        }
+
+    def index_key(self, manifest):
+        payload = json.dumps(manifest, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()[:16]
+
+    def find_snapshot(self, manifest):
+        path = os.path.join(INDEX_CACHE_DIR, self.index_key(manifest))
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            return path
+
+        if None not in manifest["revisions"].values():
+            return None
+
+        # The Hub is unreachable, so reuse the newest snapshot that was built
+        # with the same settings rather than rebuilding from nothing.
+        settings = {k: v for k, v in manifest.items() if k != "revisions"}
+        candidates = []
+        if os.path.isdir(INDEX_CACHE_DIR):
+            for name in os.listdir(INDEX_CACHE_DIR):
+                manifest_path = os.path.join(INDEX_CACHE_DIR, name, "manifest.json")
+                if not os.path.exists(manifest_path):
+                    continue
+                with open(manifest_path) as f:
+                    stored = json.load(f)
+                if {k: v for k, v in stored.items() if k != "revisions"} == settings:
+                    candidates.append((os.path.getmtime(manifest_path), os.path.dirname(manifest_path)))
+        return max(candidates)[1] if candidates else None
+
+    def save_snapshot(self, manifest):
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        path = os.path.join(INDEX_CACHE_DIR, self.index_key(manifest))
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+
+        # Write next to the final location and rename, so a crash mid-write
+        # never leaves a half-written snapshot that looks valid.
+        if isinstance(self.vectorstore.index, ShardedIndex):
+            # One file per shard, next to the shared docstore
+            os.makedirs(tmp_path, exist_ok=True)
+            self.vectorstore.index.save(os.path.join(tmp_path, "shards"))
+            with open(os.path.join(tmp_path, "index.pkl"), "wb") as f:
+                pickle.dump((self.vectorstore.docstore, self.vectorstore.index_to_docstore_id), f)
+        else:
+            self.vectorstore.save_local(tmp_path)
+        if self.product_vectorstore is not None:
+            self.product_vectorstore.save_local(os.path.join(tmp_path, "products"))
+        self.chunk_table.save(os.path.join(tmp_path, "chunks.npz"))
+        self.lexical_index.save(os.path.join(tmp_path, "lexical.npz"))
+        self.aggregates.save(os.path.join(tmp_path, "aggregates.pkl"))
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        print(f"Saved index snapshot to {path}")
+        return path
+
+    def read_index(self, index_path, mmap=False):
+        read_only = False
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                read_only = True
+            except RuntimeError:
+                index = faiss.read_index(index_path)
+        else:
+            index = faiss.read_index(index_path)
+        self.apply_search_params(index)
+        return index, read_only
+
+    def load_vectorstore(self, path, mmap=False):
+        shards_path = os.path.join(path, "shards")
+        if os.path.isdir(shards_path):
+            index, read_only = ShardedIndex.load(
+                shards_path, lambda shard_path: self.read_index(shard_path, mmap), self.shard_pool
+            )
+        else:
+            index, read_only = self.read_index(os.path.join(path, "index.faiss"), mmap)
+
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        return FAISS(self.create_embeddings(), index, docstore, index_to_docstore_id), read_only
+
+    def load_snapshot(self, path):
+        self.vectorstore, self.index_read_only = self.load_vectorstore(path, mmap=True)
+        self.snapshot_path = path
+
+        # The product index is small and takes upserts, so it is read into memory
+        products_path = os.path.join(path, "products")
+        self.product_vectorstore = None
+        if os.path.exists(products_path):
+            self.product_vectorstore, _ = self.load_vectorstore(products_path)
+        self.chunk_table = ChunkTable.load(os.path.join(path, "chunks.npz"))
+        self.lexical_index = LexicalIndex.load(os.path.join(path, "lexical.npz"))
+        self.aggregates = ProductAggregates.load(os.path.join(path, "aggregates.pkl"))
+
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+
+    def build_index(self, merged_df):
+        if merged_df is None:
+            texts = self.split_documents(FALLBACK_DOCUMENTS)
+            products = []
+        else:
+            documents, metadatas = self.documents_from_frame(merged_df)
+            texts = self.split_documents(documents, metadatas)
+            products = self.product_documents(merged_df) if self.index_layout == "hierarchical" else []
+
+        self.vectorstore = self.create_vectorstore(texts, shard_by=self.shard_by)
+        self.product_vectorstore = self.create_vectorstore(products, index_type="flat") if products else None
+        self.chunk_table = ChunkTable()
+        self.chunk_table.add(texts)
+        self.lexical_index = LexicalIndex()
+        self.lexical_index.add(texts)
+        self.aggregates = ProductAggregates()
+        if merged_df is not None:
+            self.aggregates.add(merged_df)
+
+    def load_or_build_index(self):
+        manifest = self.index_manifest()
+        path = self.find_snapshot(manifest)
+        if path is not None:
+            try:
+                print(f"Loading index snapshot from {path}")
+                self.load_snapshot(path)
+                return
+            except Exception as e:
+                print(f"Error loading index snapshot, rebuilding: {str(e)}")
+
+        embeddings = self.create_embeddings()
+        if isinstance(embeddings, EmbeddingEngine):
+            embeddings.reset_stats()
+        if self.embedding_cache is not None:
+            self.embedding_cache.reset_stats()
+        if self.streaming_ingest:
+            complete = self.build_index_streaming(manifest["revisions"])
+        else:
+            merged_df = self.prepare_data(manifest["revisions"])
+            self.build_index(merged_df)
+            complete = merged_df is not None
+        if isinstance(embeddings, EmbeddingEngine):
+            # Worker processes are only needed for bulk encoding
+            embeddings.report()
+            embeddings.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.report()
+
+        self.manifest = manifest
+        self.index_read_only = False
+        if complete and None not in manifest["revisions"].values():
+            self.snapshot_path = self.save_snapshot(manifest)
+
+    def review_chunk_ids(self, review_id, vectorstore=None):
+        vectorstore = vectorstore or self.vectorstore
+        chunk_ids = []
+        while faiss_id(f"{review_id}:{len(chunk_ids)}") in vectorstore.index_to_docstore_id:
+            chunk_ids.append(f"{review_id}:{len(chunk_ids)}")
+        return chunk_ids
+
+    def ensure_writable_index(self):
+        # Memory-mapped snapshots are read-only; load a private copy before the
+        # first change
+        if self.index_read_only:
+            if isinstance(self.vectorstore.index, ShardedIndex):
+                index, _ = ShardedIndex.load(os.path.join(self.snapshot_path, "shards"), self.read_index, self.shard_pool)
+            else:
+                index, _ = self.read_index(os.path.join(self.snapshot_path, "index.faiss"))
+            self.vectorstore.index = index
+            self.index_read_only = False
+
+    def remove_reviews(self, review_ids):
+        # Callers hold the index lock for writing
+        self.ensure_writable_index()
+        chunk_ids = [chunk_id for review_id in review_ids for chunk_id in self.review_chunk_ids(review_id)]
+        if chunk_ids:
+            self.remove_from_vectorstore(self.vectorstore, chunk_ids)
+            labels = [faiss_id(chunk_id) for chunk_id in chunk_ids]
+            self.chunk_table.remove(labels)
+            self.lexical_index.remove(labels)
+            self.index_generation += 1
+        self.aggregates.remove(review_ids)
+        return len(chunk_ids)
+
+    def persist_snapshot(self):
+        # Searches go on while the snapshot is written
+        with self.index_lock.reading(), self.snapshot_lock:
+            self.save_snapshot(self.manifest)
+
+    def delete_reviews(self, review_ids, persist=False):
+        with self.index_lock.writing():
+            num_chunks = self.remove_reviews(review_ids)
+        print(f"Deleted {num_chunks} chunks")
+
+        if persist:
+            self.persist_snapshot()
+        return num_chunks
+
+    def upsert_reviews(self, reviews_df, products_df=None, persist=False):
+        # Only the given reviews are embedded; the rest of the index is untouched
+        if products_df is None:
+            if self.products_df is None:
+                self.products_df = load_dataset(
+                    PRODUCTS_DATASET,
+                    token=os.environ.get("HF_TOKEN"),
+                    trust_remote_code=True
+                )['train'].to_pandas()
+            products_df = self.products_df
+
+        # Chunking and embedding happen before the index is locked, so
+        # searches only wait for the in-memory changes
+        merged_df = self.merge_products(reviews_df, products_df)
+        documents, metadatas = self.documents_from_frame(merged_df)
+        texts = self.split_documents(documents, metadatas)
+        vectors = self.embed_texts(self.vectorstore.embedding_function, texts) if texts else None
+        products, product_vectors = [], None
+        if self.product_vectorstore is not None:
+            products = self.product_documents(merged_df)
+            if products:
+                product_vectors = self.embed_texts(self.product_vectorstore.embedding_function, products)
+        embeddings = self.vectorstore.embedding_function
+        if isinstance(embeddings, EmbeddingEngine):
+            # A large upsert starts the worker processes; like an index
+            # build, it stops them once its chunks are encoded
+            embeddings.close()
+
+        with self.index_lock.writing():
+            self.remove_reviews({metadata["review_id"] for metadata in metadatas})
+            if texts:
+                self.add_to_vectorstore(self.vectorstore, texts, vectors)
+                self.chunk_table.add(texts)
+                self.lexical_index.add(texts)
+            self.aggregates.add(merged_df)
+
+            # Product headers are refreshed too, in case the price or name changed
+            if self.product_vectorstore is not None:
+                existing = [
+                    product.metadata["chunk_id"] for product in products
+                    if faiss_id(product.metadata["chunk_id"]) in self.product_vectorstore.index_to_docstore_id
+                ]
+                if existing:
+                    self.remove_from_vectorstore(self.product_vectorstore, existing)
+                if products:
+                    self.add_to_vectorstore(self.product_vectorstore, products, product_vectors)
+            self.index_generation += 1
+        print(f"Upserted {len(documents)} reviews ({len(texts)} chunks)")
+
+        if persist:
+            self.persist_snapshot()
+        return len(texts)
+
+    def check_memory(self, batch_size):
+        if not self.ingest_memory_limit_mb:
+            return batch_size
+
+        limit = self.ingest_memory_limit_mb * 1024 * 1024
+        rss = current_rss_bytes()
+        if rss > limit:
+            gc.collect()
+            rss = current_rss_bytes()
+            if rss > limit:
+                raise MemoryError(
+                    f"Ingestion exceeded the {self.ingest_memory_limit_mb} MB memory limit "
+                    f"({rss / 1024 / 1024:.0f} MB resident)"
+                )
+
+        # Close to the ceiling: shrink batches so the next one fits under it
+        if rss > 0.8 * limit and batch_size > 1:
+            batch_size = max(1, batch_size // 2)
+            print(f"Memory at {rss / 1024 / 1024:.0f} MB, reducing ingest batch size to {batch_size}")
+        return batch_size
+
+    def build_index_streaming(self, revisions):
+        # Only the products table (small) is held in memory; reviews are
+        # streamed, joined, chunked, embedded and indexed one batch at a time.
+        try:
+            products_dataset = load_dataset(
+                PRODUCTS_DATASET,
+                revision=revisions.get(PRODUCTS_DATASET),
+                token=os.environ.get("HF_TOKEN"),
+                trust_remote_code=True
+            )
+            products_df = products_dataset['train'].to_pandas()
+            self.products_df = products_df
+
+            reviews_dataset = load_dataset(
+                REVIEWS_DATASET,
+                revision=revisions.get(REVIEWS_DATASET),
+                split="train",
+                streaming=True,
+                token=os.environ.get("HF_TOKEN"),
+                trust_remote_code=True
+            )
+        except Exception as e:
+            print(f"Error loading datasets: {str(e)}")
+            self.build_index(None)
+            return False
+
+        embeddings = self.create_embeddings()
+        vectorstore = None
+        chunk_table = ChunkTable()
+        lexical_index = LexicalIndex()
+        aggregates = ProductAggregates()
+        product_rows = []
+        batch_size = self.ingest_batch_size
+        pending, pending_rows = [], 0
+        num_reviews, num_chunks = 0, 0
+
+        def flush(frames):
+            nonlocal vectorstore, num_reviews, num_chunks
+            merged_df = self.merge_products(pd.concat(frames, ignore_index=True), products_df)
+            documents, metadatas = self.documents_from_frame(merged_df)
+            texts = self.split_documents(documents, metadatas)
+            product_rows.append(merged_df.drop_duplicates('product_name', keep='last'))
+            if vectorstore is None:
+                vectorstore = self.create_vectorstore(texts, embeddings, shard_by=self.shard_by)
+            else:
+                # A review repeated in a later batch replaces the earlier copy,
+                # the same as the in-memory path keeping the last duplicate
+                stale_ids = [
+                    chunk_id for metadata in metadatas
+                    for chunk_id in self.review_chunk_ids(metadata["review_id"], vectorstore)
+                ]
+                if stale_ids:
+                    self.remove_from_vectorstore(vectorstore, stale_ids)
+                    stale_labels = [faiss_id(chunk_id) for chunk_id in stale_ids]
+                    chunk_table.remove(stale_labels)
+                    lexical_index.remove(stale_labels)
+                self.add_to_vectorstore(vectorstore, texts)
+            chunk_table.add(texts)
+            lexical_index.add(texts)
+            aggregates.add(merged_df)
+            num_reviews += len(documents)
+            num_chunks += len(texts)
+
+        # Read in small units so a shrinking batch size takes effect immediately
+        for rows in reviews_dataset.iter(batch_size=min(256, batch_size)):
+            pending.append(pd.DataFrame(rows))
+            pending_rows += len(pending[-1])
+            if pending_rows >= batch_size:
+                flush(pending)
+                pending, pending_rows = [], 0
+                batch_size = self.check_memory(batch_size)
+                print(f"Indexed {num_reviews} reviews ({num_chunks} chunks), "
+                      f"{current_rss_bytes() / 1024 / 1024:.0f} MB resident")
+
+        if pending:
+            flush(pending)
+
+        if vectorstore is None:
+            print("Reviews dataset is empty")
+            self.build_index(None)
+            return False
+
+        if isinstance(vectorstore.index, ShardedIndex):
+            shards = vectorstore.index.shards
+            for key in list(shards):
+                shards[key] = self.grow_ivf(shards[key], final=True)
+        else:
+            vectorstore.index = self.grow_ivf(vectorstore.index, final=True)
+
+        self.vectorstore = vectorstore
+        self.chunk_table = chunk_table
+        self.lexical_index = lexical_index
+        self.aggregates = aggregates
+        self.product_vectorstore = None
+        if self.index_layout == "hierarchical":
+            products = self.product_documents(pd.concat(product_rows, ignore_index=True))
+            if products:
+                self.product_vectorstore = self.create_vectorstore(products, embeddings, index_type="flat")
+
+        print(f"Indexed {num_reviews} reviews ({num_chunks} chunks)")
+        return True
+
+def build_arg_parser():
+    # Options shared by the command line and the Gradio app
+    parser = argparse.ArgumentParser(description="BestBuy Product Review Assistant")
+    parser.add_argument("--index-layout", choices=INDEX_LAYOUTS, default=INDEX_LAYOUT,
+                        help="hierarchical: product index plus review index; flat: one combined index")
+    parser.add_argument("--shard-by", choices=SHARD_MODES, default=SHARD_BY,
+                        help="Split the review index into one shard per category or brand, searched in parallel")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=FAISS_INDEX_TYPE,
+                        help="FAISS index used for review search")
+    parser.add_argument("--nlist", type=int, default=FAISS_NLIST, help="Inverted lists for the ivf index")
+    parser.add_argument("--nprobe", type=int, default=FAISS_NPROBE, help="Lists probed per query for the ivf index")
+    parser.add_argument("--hnsw-m", type=int, default=FAISS_HNSW_M, help="Graph degree for the hnsw index")
+    parser.add_argument("--ef-search", type=int, default=FAISS_EF_SEARCH, help="Search depth for the hnsw index")
+    parser.add_argument("--embedding-workers", type=int, default=EMBEDDING_WORKERS,
+                        help="Processes encoding chunks during index builds (0: one per --embedding-threads cores)")
+    parser.add_argument("--embedding-threads", type=int, default=EMBEDDING_THREADS,
+                        help="Torch threads per embedding worker")
+    parser.add_argument("--llm-backend", choices=LLM_BACKENDS, default=LLM_BACKEND,
+                        help="hf: transformers on GPU; llama_cpp or ctranslate2: quantized model on CPU")
+    parser.add_argument("--generation-batch-size", type=int, default=GENERATION_BATCH_SIZE,
+                        help="Most chat requests decoded together in one forward pass")
+    parser.add_argument("--no-context-packing", dest="context_packing", action="store_false", default=CONTEXT_PACKING,
+                        help="Send the top 3 chunks instead of filling the prompt's token budget")
+    parser.add_argument("--no-semantic-cache", dest="semantic_cache", action="store_false", default=SEMANTIC_CACHE,
+                        help="Always generate answers instead of reusing answers to similar questions")
+    parser.add_argument("--no-aggregate-routing", dest="aggregate_routing", action="store_false",
+                        default=AGGREGATE_ROUTING,
+                        help="Send rating, review count, price and helpful-vote questions to the LLM too")
+    parser.add_argument("--diversity", choices=DIVERSITY_MODES, default=DIVERSITY,
+                        help="Spread retrieved chunks over reviews and products (mmr or caps) or not (off)")
+    parser.add_argument("--rerank", action="store_true", default=RERANK,
+                        help="Rescore retrieved chunks with a cross-encoder before building the prompt")
+    parser.add_argument("--no-filters", dest="query_filters", action="store_false", default=QUERY_FILTERS,
+                        help="Do not restrict the search by brand, category, price, rating or verified purchases")
+    parser.add_argument("--no-hybrid", dest="hybrid_search", action="store_false", default=HYBRID_SEARCH,
+                        help="Disable BM25 search alongside the vector search")
+    return parser
+
+def chat_options(args):
+    return {
+        "index_layout": args.index_layout,
+        "shard_by": args.shard_by,
+        "query_filters": args.query_filters,
+        "hybrid_search": args.hybrid_search,
+        "aggregate_routing": args.aggregate_routing,
+        "rerank": args.rerank,
+        "diversity": args.diversity,
+        "embedding_workers": args.embedding_workers,
+        "embedding_threads": args.embedding_threads,
+        "index_type": args.index_type,
+        "nlist": args.nlist,
+        "nprobe": args.nprobe,
+        "hnsw_m": args.hnsw_m,
+        "ef_search": args.ef_search,
+        "generation_batch_size": args.generation_batch_size,
+        "llm_backend": args.llm_backend,
+        "context_packing": args.context_packing,
+        "semantic_cache": args.semantic_cache,
+    }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import bestbuy_rag from the repository root, like the apps do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,66 @@
+import numpy as np
+
+import bestbuy_rag
+from bestbuy_rag import SemanticAnswerCache
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+CONTEXT = SemanticAnswerCache.context_key([], {"filters": {}, "products": []})
+
+def test_near_duplicates_hit_and_others_miss():
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    cache.put(unit(1, 0, 0), CONTEXT, "v1", "Great battery.", 2.0)
+    assert cache.get(unit(1, 0.1, 0), CONTEXT, "v1") == "Great battery."
+    assert cache.get(unit(1, 1, 0), CONTEXT, "v1") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["saved_generation_seconds"]) == (1, 1, 2.0)
+
+def test_context_and_scope_are_part_of_the_key():
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    under_300 = SemanticAnswerCache.context_key([], {"filters": {"max_price": 300.0}, "products": []})
+    under_500 = SemanticAnswerCache.context_key([], {"filters": {"max_price": 500.0}, "products": []})
+    cache.put(unit(1, 0), under_300, "v1", "Phone A", 1.0)
+    assert cache.get(unit(1, 0), under_500, "v1") is None
+    assert cache.get(unit(1, 0), under_300, "v1") == "Phone A"
+
+    # Only the exchanges that reach the prompt matter
+    history = [("q1", "a1"), ("q2", "a2"), ("q3", "a3"), ("q4", "a4")]
+    assert SemanticAnswerCache.context_key(history) == SemanticAnswerCache.context_key([("q0", "a0")] + history)
+    assert SemanticAnswerCache.context_key(history) != SemanticAnswerCache.context_key(history[:-1])
+
+def test_index_changes_and_age_invalidate_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bestbuy_rag.time, "monotonic", lambda: now[0])
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    cache.put(unit(1, 0), CONTEXT, "v1", "old", 1.0)
+    assert cache.get(unit(1, 0), CONTEXT, "v2") is None
+    assert cache.stats()["entries"] == 0
+
+    cache.put(unit(1, 0), CONTEXT, "v2", "new", 1.0)
+    now[0] += 59
+    assert cache.get(unit(1, 0), CONTEXT, "v2") == "new"
+    now[0] += 2
+    assert cache.get(unit(1, 0), CONTEXT, "v2") is None
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, max_entries=2)
+    cache.put(unit(1, 0, 0), CONTEXT, "v1", "x", 1.0)
+    cache.put(unit(0, 1, 0), CONTEXT, "v1", "y", 1.0)
+    assert cache.get(unit(1, 0, 0), CONTEXT, "v1") == "x"
+    cache.put(unit(0, 0, 1), CONTEXT, "v1", "z", 1.0)
+    assert cache.get(unit(0, 1, 0), CONTEXT, "v1") is None
+    assert cache.get(unit(1, 0, 0), CONTEXT, "v1") == "x"
+    assert cache.get(unit(0, 0, 1), CONTEXT, "v1") == "z"
+
+def test_size_limit():
+    vector = unit(1, 0)
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, max_entries=10, max_bytes=vector.nbytes + len(CONTEXT) + 10)
+    cache.put(vector, CONTEXT, "v1", "a" * 100, 1.0)
+    assert cache.stats()["entries"] == 0
+    cache.put(vector, CONTEXT, "v1", "short", 1.0)
+    cache.put(unit(0, 1), CONTEXT, "v1", "other", 1.0)
+    assert cache.stats()["entries"] == 1
+    assert cache.get(unit(0, 1), CONTEXT, "v1") == "other"
+    assert cache.stats()["bytes"] <= cache.max_bytes
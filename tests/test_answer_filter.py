@@ -0,0 +1,29 @@
+from bestbuy_rag import AnswerFilter
+
+def stream(pieces):
+    # What the filter lets through for each piece, then on finish()
+    answer_filter = AnswerFilter()
+    return [answer_filter.feed(piece) for piece in pieces] + [answer_filter.finish()]
+
+def test_leading_marker_is_dropped_even_when_split():
+    assert "".join(stream(["Help", "ful Ans", "wer: The", " battery is great."])) == "The battery is great."
+    assert "".join(stream(["  Helpful Answer:  Fast", " charging"])) == "Fast charging"
+
+def test_answer_ends_at_a_stop_marker():
+    assert "".join(stream(["The battery", " is good. Helpful", " Answer: again"])) == "The battery is good."
+    assert "".join(stream(["Good camera.\n\nUnhel", "pful Answer: bad"])) == "Good camera."
+
+def test_possible_markers_are_held_back_until_resolved():
+    pieces = stream(["Great phone. Unh", "appy? no"])
+    assert pieces[0] == "Great phone."
+    assert "".join(pieces) == "Great phone. Unhappy? no"
+    # Text past a stop marker is never released
+    answer_filter = AnswerFilter()
+    answer_filter.feed("Done. Unhelpful")
+    assert answer_filter.done
+    assert answer_filter.feed(" more") == "" and answer_filter.finish() == ""
+
+def test_trailing_whitespace_and_empty_answers():
+    assert stream(["Great phone.  ", "  "]) == ["Great phone.", "", ""]
+    assert "".join(stream(["Helpful Answer:", "  "])) == ""
+    assert stream([]) == [""]
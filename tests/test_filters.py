@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from bestbuy_rag import BestBuyRAGChat, ChunkTable, faiss_id
+
+CHUNKS = [
+    # chunk ID, product, brand, category, price, rating, verified
+    ("r1:0", "p1", "Samsung", "Cell Phones", 399.99, 5.0, True),
+    ("r1:1", "p1", "Samsung", "Cell Phones", 399.99, 5.0, True),
+    ("r2:0", "p2", "Apple", "Cell Phones", 799.0, 4.0, False),
+    ("r3:0", "p3", "Samsung", "Tablets", 249.5, 2.0, True),
+    ("r4:0", "p4", None, "Tablets", np.nan, 3.0, False),
+]
+
+def chunk(chunk_id, product, brand, category, price, rating, verified):
+    return Document(page_content=chunk_id, metadata={
+        "chunk_id": chunk_id, "product_id": product, "brand": brand, "category": category,
+        "price": price, "rating": rating, "verified_purchase": verified,
+    })
+
+@pytest.fixture
+def table():
+    table = ChunkTable()
+    table.add([chunk(*row) for row in CHUNKS])
+    return table
+
+CHUNK_IDS = {faiss_id(chunk_id): chunk_id for chunk_id in ["r1:0", "r1:1", "r2:0", "r3:0", "r4:0", "r5:0"]}
+
+def selected(table, filters, products=None):
+    # Chunk IDs of the selected rows, None when nothing is filtered
+    rows = table.select(filters, products)
+    return None if rows is None else sorted(CHUNK_IDS[label] for label in table.columns["label"][rows].tolist())
+
+def test_select_matches_every_filter(table):
+    assert selected(table, {}) is None
+    assert selected(table, {"brand": "samsung"}) == ["r1:0", "r1:1", "r3:0"]
+    assert selected(table, {"brand": " SAMSUNG ", "category": "tablets"}) == ["r3:0"]
+    assert selected(table, {"max_price": 400}) == ["r1:0", "r1:1", "r3:0"]
+    assert selected(table, {"min_price": 300, "max_price": 800}) == ["r1:0", "r1:1", "r2:0"]
+    assert selected(table, {"min_rating": 4}) == ["r1:0", "r1:1", "r2:0"]
+    assert selected(table, {"verified": False}) == ["r2:0", "r4:0"]
+    assert selected(table, {"brand": "google"}) == []
+    assert selected(table, {"category": "cell phones"}, [faiss_id("p2"), faiss_id("p3")]) == ["r2:0"]
+
+def test_select_follows_updates(table):
+    assert selected(table, {"brand": "apple"}) == ["r2:0"]
+    table.remove([faiss_id("r2:0")])
+    assert selected(table, {"brand": "apple"}) == []
+    table.add([chunk("r5:0", "p5", "Apple", "Tablets", 999.0, 5.0, True)])
+    assert selected(table, {"brand": "apple"}) == ["r5:0"]
+
+def test_contains_checks_labels_against_rows(table):
+    rows = table.select({"brand": "samsung"})
+    labels = np.array([faiss_id(chunk_id) for chunk_id in ("r1:1", "r2:0", "r3:0", "missing")], dtype=np.int64)
+    assert table.contains(labels, rows).tolist() == [True, False, True, False]
+
+def test_save_and_load_keep_the_vocabulary(table, tmp_path):
+    table.save(tmp_path / "chunks.npz")
+    loaded = ChunkTable.load(tmp_path / "chunks.npz")
+    assert selected(loaded, {"brand": "samsung", "verified": True}) == ["r1:0", "r1:1", "r3:0"]
+
+@pytest.fixture
+def chat(table):
+    chat = BestBuyRAGChat()
+    chat.chunk_table = table
+    return chat
+
+def prices(chat, question):
+    return {name: value for name, value in chat.parse_filters(question).items() if "price" in name}
+
+def test_parse_filters_reads_brand_category_rating_and_verified(chat):
+    assert chat.parse_filters("verified samsung tablets with 4+ stars") == {
+        "brand": "samsung", "category": "tablets", "min_rating": 4.0, "verified": True
+    }
+    assert chat.parse_filters("apple phones under 3 stars") == {"brand": "apple", "max_rating": 3.0}
+    assert chat.parse_filters("5 stars") == {"min_rating": 5.0, "max_rating": 5.0}
+    # Brands are only recognised when the data has them
+    assert chat.parse_filters("google pixel") == {}
+
+@pytest.mark.parametrize("question, expected", [
+    ("under $500", {"max_price": 500.0}),
+    ("under 500 dollars", {"max_price": 500.0}),
+    ("over 300 bucks", {"min_price": 300.0}),
+    ("price under 500", {"max_price": 500.0}),
+    ("my budget is under 600", {"max_price": 600.0}),
+    ("costs less than 450.50", {"max_price": 450.5}),
+    ("cheaper than 700", {"max_price": 700.0}),
+    ("more expensive than 900", {"min_price": 900.0}),
+    ("between $300 and $1,000", {"min_price": 300.0, "max_price": 1000.0}),
+    ("price between 600 and 300", {"min_price": 300.0, "max_price": 600.0}),
+    ("more than 2 cameras and under $800", {"max_price": 800.0}),
+])
+def test_parse_filters_reads_prices(chat, question, expected):
+    assert prices(chat, question) == expected
+
+@pytest.mark.parametrize("question", [
+    "more than 2 cameras", "less than 128 storage", "under 500", "phone under 6 inches",
+    "at least 8GB of RAM", "reviews from 2023", "between 2 and 3 days",
+])
+def test_parse_filters_ignores_numbers_that_are_not_prices(chat, question):
+    assert prices(chat, question) == {}
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from bestbuy_rag import GenerationScheduler
+
+WORDS = "great phone battery screen camera love hate price fast slow nice".split()
+NEW_TOKENS = 12
+
+class GreedyScheduler(GenerationScheduler):
+    # Picks the most likely token and runs every request to max_new_tokens,
+    # so its output can be compared with generate() token for token
+
+    def sample(self, logits, requests):
+        return logits.argmax(dim=-1).tolist()
+
+    def finished(self, request):
+        return request.cancelled or len(request.tokens) >= request.max_new_tokens
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    vocab = {word: i for i, word in enumerate(["<unk>", "<s>", "</s>"] + WORDS)}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+
+@pytest.fixture(scope="module")
+def model(tokenizer):
+    # A tiny Llama with random weights; only the attention and cache code matter
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=None, pad_token_id=tokenizer.eos_token_id
+    )
+    return LlamaForCausalLM(config).eval()
+
+def reference(model, prompt_ids):
+    with torch.no_grad():
+        output = model.generate(
+            prompt_ids[None, :], attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long),
+            max_new_tokens=NEW_TOKENS, do_sample=False, eos_token_id=None, pad_token_id=model.config.pad_token_id
+        )
+    return output[0, len(prompt_ids):].tolist()
+
+def run(scheduler, prompts, prefix=None):
+    # Requests arrive a little apart, so some join a batch that is decoding
+    requests = []
+    for i, prompt in enumerate(prompts):
+        requests.append(scheduler.enqueue(prompt, prefix=prefix, max_new_tokens=NEW_TOKENS))
+        time.sleep(0.002 * (i % 3))
+    for request in requests:
+        request.future.result(timeout=60)
+    return requests
+
+def test_batched_generation_matches_generate(model, tokenizer):
+    # Prompts of different lengths are left-padded into one batch
+    prompts = ["great phone " + "fast slow " * n for n in (1, 4, 9, 2, 6)] + ["nice " * n for n in (3, 7)]
+    for batch_size in (1, 4):
+        scheduler = GreedyScheduler(model, tokenizer, max_length=256, max_batch_size=batch_size, repetition_penalty=1.0)
+        for request in run(scheduler, prompts):
+            assert request.tokens == reference(model, request.prompt_ids)
+
+def test_prefix_cached_generation_matches_generate(model, tokenizer):
+    # Requests sharing the prefix reuse its cached keys and values; one
+    # without it is batched alongside them
+    prefix = "great phone battery screen camera love hate price " * 3
+    prompts = [prefix + "fast slow " * n for n in (1, 5, 2, 8)] + ["nice camera " * 4]
+    scheduler = GreedyScheduler(model, tokenizer, max_length=256, max_batch_size=4, repetition_penalty=1.0)
+    requests = run(scheduler, prompts, prefix=prefix)
+    for request in requests:
+        assert request.tokens == reference(model, request.prompt_ids)
+    assert [request.prefix_length > 0 for request in requests] == [True] * 4 + [False]
+    assert scheduler.stats()["reused_prefix_tokens"] == sum(request.prefix_length for request in requests)
@@ -0,0 +1,68 @@
+import numpy as np
+from langchain.schema import Document
+
+from bestbuy_rag import LexicalIndex, faiss_id
+
+def chunk(chunk_id, text, model=None):
+    return Document(page_content=text, metadata={"chunk_id": chunk_id, "product_model": model})
+
+def chunk_ids(labels, chunk_ids):
+    names = {faiss_id(chunk_id): chunk_id for chunk_id in chunk_ids}
+    return [names[label] for label in labels.tolist()]
+
+CHUNKS = [
+    chunk("a:0", "The battery lasts two days, great battery", "SM-S911U"),
+    chunk("b:0", "Screen is bright but the battery drains fast", "A2649"),
+    chunk("c:0", "Camera is sharp in low light", "SM-S911U"),
+    chunk("d:0", "Shipping was slow"),
+]
+ALL = [text.metadata["chunk_id"] for text in CHUNKS] + ["e:0"]
+
+def test_search_ranks_by_bm25():
+    index = LexicalIndex()
+    index.add(CHUNKS)
+    assert len(index) == 4
+    # Two mentions in a shorter chunk beat one
+    assert chunk_ids(index.search("battery", 10), ALL) == ["a:0", "b:0"]
+    assert chunk_ids(index.search("battery", 1), ALL) == ["a:0"]
+    assert len(index.search("the of", 10)) == 0
+    assert len(index.search("unknown words", 10)) == 0
+
+def test_search_matches_model_numbers_and_their_parts():
+    index = LexicalIndex()
+    index.add(CHUNKS)
+    assert sorted(chunk_ids(index.search("SM-S911U", 10), ALL)) == ["a:0", "c:0"]
+    assert chunk_ids(index.search("a2649 screen", 10), ALL) == ["b:0"]
+
+def test_keep_masks_out_filtered_labels():
+    index = LexicalIndex()
+    index.add(CHUNKS)
+    allowed = np.array([faiss_id("b:0")])
+    assert chunk_ids(index.search("battery", 10, keep=lambda labels: np.isin(labels, allowed)), ALL) == ["b:0"]
+
+def test_add_and_remove_keep_results_consistent():
+    index = LexicalIndex()
+    index.add(CHUNKS[:2])
+    index.add(CHUNKS[2:])
+    index.add([chunk("e:0", "Battery battery battery")])
+    assert chunk_ids(index.search("battery", 10), ALL) == ["e:0", "a:0", "b:0"]
+
+    index.remove([faiss_id("a:0"), faiss_id("e:0")])
+    assert len(index) == 3
+    assert chunk_ids(index.search("battery", 10), ALL) == ["b:0"]
+    assert chunk_ids(index.search("camera", 10), ALL) == ["c:0"]
+    # Removing labels that are not indexed changes nothing
+    index.remove([faiss_id("missing")])
+    assert len(index) == 3
+
+    # The rebuilt index scores like one built from the remaining chunks alone
+    fresh = LexicalIndex()
+    fresh.add(CHUNKS[1:])
+    assert chunk_ids(index.search("slow screen light", 10), ALL) == chunk_ids(fresh.search("slow screen light", 10), ALL)
+
+def test_save_and_load(tmp_path):
+    index = LexicalIndex()
+    index.add(CHUNKS)
+    index.save(tmp_path / "lexical.npz")
+    loaded = LexicalIndex.load(tmp_path / "lexical.npz")
+    assert chunk_ids(loaded.search("battery", 10), ALL) == chunk_ids(index.search("battery", 10), ALL)
@@ -0,0 +1,51 @@
+import bestbuy_rag
+from bestbuy_rag import SessionStore
+
+def test_sessions_are_kept_apart_and_bounded_in_turns():
+    store = SessionStore(max_turns=2, max_session_kb=64, idle_seconds=60, max_mb=1)
+    assert store.history("a") == []
+    for turn in range(3):
+        store.append("a", f"q{turn}", f"a{turn}")
+    store.append("b", "hello", "hi")
+    assert store.history("a") == [("q1", "a1"), ("q2", "a2")]
+    assert store.history("b") == [("hello", "hi")]
+    # Callers get a copy
+    store.history("a").append(("x", "y"))
+    assert len(store.history("a")) == 2
+
+    store.clear("a")
+    assert store.history("a") == []
+    assert store.stats() == {"sessions": 1, "bytes": SessionStore.turn_bytes("hello", "hi"), "evictions": 0}
+
+def test_session_byte_limit_keeps_the_newest_turn():
+    store = SessionStore(max_turns=10, max_session_kb=1, idle_seconds=60, max_mb=1)
+    store.append("a", "q0", "x" * 600)
+    store.append("a", "q1", "y" * 600)
+    assert [message for message, _ in store.history("a")] == ["q1"]
+    store.append("a", "q2", "z" * 2000)
+    assert [message for message, _ in store.history("a")] == ["q2"]
+    assert store.stats()["bytes"] == SessionStore.turn_bytes("q2", "z" * 2000)
+
+def test_idle_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bestbuy_rag.time, "monotonic", lambda: now[0])
+    store = SessionStore(max_turns=10, max_session_kb=64, idle_seconds=60, max_mb=1)
+    store.append("a", "q", "a")
+    store.append("b", "q", "a")
+    now[0] += 40
+    store.history("b")
+    now[0] += 30
+    assert store.history("a") == []
+    assert store.history("b") == [("q", "a")]
+    assert store.stats()["evictions"] == 1
+
+def test_least_recently_used_sessions_are_evicted_over_the_store_limit():
+    store = SessionStore(max_turns=10, max_session_kb=64, idle_seconds=60, max_mb=2500 / (1024 * 1024))
+    store.append("a", "q", "x" * 1000)
+    store.append("b", "q", "x" * 1000)
+    store.history("a")
+    store.append("c", "q", "x" * 1000)
+    assert len(store) == 2
+    assert store.history("b") == []
+    assert store.history("a") and store.history("c")
+    assert store.stats()["evictions"] == 1
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bestbuy_rag import DOCUMENT_TEMPLATE, build_combined_text
+
+# Number of synthetic review rows, can be overridden from the command line
+num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+rng = np.random.default_rng(0)
+
+# Build a frame with the same columns and dtypes as the merged reviews/products data
+words = np.array(['battery', 'screen', 'camera', 'fast', 'slow', 'great', 'price', 'phone'])
+review_text = pd.Series(rng.choice(words, size=(num_rows, 40)).tolist()).str.join(' ')
+df = pd.DataFrame({
+    'product_name': rng.choice(['Samsung Galaxy S24', 'Apple iPhone 15', 'Google Pixel 8'], num_rows),
+    'brand': rng.choice(['Samsung', 'Apple', 'Google', None], num_rows),
+    'price': rng.choice([799.99, 999.99, 699.99, np.nan], num_rows),
+    'category': rng.choice(['Cell Phones', 'Unlocked Phones'], num_rows),
+    'product_model': rng.choice(['SM-S921U', 'MTLT3LL/A', 'GA04832-US'], num_rows),
+    'rating': rng.integers(1, 6, num_rows).astype(float),
+    'review_title': rng.choice(['Great phone', 'Battery drains fast', 'Love it'], num_rows),
+    'review_text': review_text,
+    'verified_purchase': rng.random(num_rows) < 0.7,
+    'helpful_count': rng.integers(0, 50, num_rows),
+})
+print(f"Synthetic frame shape: {df.shape}")
+
+# Row-wise apply, as prepare_data used to build documents
+start = time.perf_counter()
+apply_text = df.apply(lambda x: f"""
+            Product: {x['product_name']}
+            Brand: {x['brand']}
+            Price: ${x['price']}
+            Category: {x['category']}
+            Model: {x['product_model']}
+            Rating: {x['rating']}
+            Title: {x['review_title']}
+            Review: {x['review_text']}
+            Verified Purchase: {x['verified_purchase']}
+            Helpful Votes: {x['helpful_count']}
+            """, axis=1)
+apply_seconds = time.perf_counter() - start
+
+# Columnar builder over whole columns
+start = time.perf_counter()
+vectorized_text = build_combined_text(df, DOCUMENT_TEMPLATE)
+vectorized_seconds = time.perf_counter() - start
+
+if apply_text.tolist() != vectorized_text.tolist():
+    raise ValueError("Vectorized builder output differs from the row-wise apply output")
+
+print(f"apply:      {apply_seconds:8.2f}s  {num_rows / apply_seconds:12,.0f} rows/sec")
+print(f"vectorized: {vectorized_seconds:8.2f}s  {num_rows / vectorized_seconds:12,.0f} rows/sec")
+print(f"Speedup: {apply_seconds / vectorized_seconds:.1f}x")
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import numpy as np
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bestbuy_rag import EMBEDDING_MODEL, BestBuyRAGChat, EmbeddingEngine
+
+# Number of review chunks to encode, and the worker counts to compare
+num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+worker_counts = [int(n) for n in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1, 2, 4]
+
+
+def main():
+    chat = BestBuyRAGChat()
+    documents, metadatas = chat.documents_from_frame(chat.prepare_data())
+    texts = [text.page_content for text in chat.split_documents(documents, metadatas)[:num_chunks]]
+    print(f"Encoding {len(texts)} chunks on {os.cpu_count()} cores")
+
+    # LangChain's defaults, as create_vectorstore used before
+    start = time.perf_counter()
+    reference = np.asarray(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL).embed_documents(texts))
+    seconds = time.perf_counter() - start
+    print(f"HuggingFaceEmbeddings: {seconds:8.1f}s  {len(texts) / seconds:8.0f} chunks/sec")
+
+    for workers in worker_counts:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        engine = EmbeddingEngine(EMBEDDING_MODEL, workers=workers, threads_per_worker=threads)
+        start = time.perf_counter()
+        vectors = np.asarray(engine.embed_documents(texts))
+        seconds = time.perf_counter() - start
+        engine.close()
+        print(f"EmbeddingEngine {workers}x{threads}: {seconds:8.1f}s  {len(texts) / seconds:8.0f} chunks/sec"
+              f"  max diff {np.abs(vectors - reference).max():.2e}")
+
+
+# Worker processes are spawned and re-import this file
+if __name__ == "__main__":
+    main()
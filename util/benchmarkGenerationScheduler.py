@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bestbuy_rag import LLM_MODEL, GenerationScheduler
+
+# Model to load, number of concurrent users and tokens generated per answer
+model_name = sys.argv[1] if len(sys.argv) > 1 else LLM_MODEL
+num_users = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+new_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+
+token = os.environ.get("HF_TOKEN")
+tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+model = AutoModelForCausalLM.from_pretrained(
+    model_name,
+    token=token,
+    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32
+).to("cuda" if torch.cuda.is_available() else "cpu").eval()
+
+questions = [
+    "What are the most common complaints about the Samsung Galaxy S24?",
+    "Which phone under $500 has the best battery life?",
+    "How does the iPhone 15 compare to the Pixel 8 for camera quality?",
+    "What's the average rating for the Motorola Edge?",
+]
+prompts = [f"Question: {questions[i % len(questions)]}\nHelpful Answer:" for i in range(num_users)]
+
+print(f"{'batch size':>10}{'seconds':>10}{'tokens/sec':>12}")
+for batch_size in sorted({1, num_users}):
+    scheduler = GenerationScheduler(model, tokenizer, max_length=0, max_batch_size=batch_size)
+    # Every user gets the same number of new tokens, so runs are comparable
+    scheduler.finished = lambda request: len(request.tokens) >= new_tokens
+
+    start = time.perf_counter()
+    # All users submit at once, as a burst of Gradio requests would
+    futures = [scheduler.submit(prompt) for prompt in prompts]
+    for future in futures:
+        future.result()
+    seconds = time.perf_counter() - start
+    print(f"{batch_size:>10}{seconds:>10.1f}{num_users * new_tokens / seconds:>12.1f}")
@@ -0,0 +1,87 @@
+import os
+import re
+import sys
+import time
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bestbuy_rag import BestBuyRAGChat, faiss_id
+
+# Neighbours per query (the retriever uses k=3) and number of sampled queries
+k = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+
+def main():
+    # Embed the review corpus once and reuse the vectors for every index type
+    chat = BestBuyRAGChat()
+    documents, metadatas = chat.documents_from_frame(chat.prepare_data())
+    texts = chat.split_documents(documents, metadatas)
+    embeddings = chat.create_embeddings()
+
+    start = time.perf_counter()
+    vectors = chat.embed_texts(embeddings, texts)
+    print(f"Embedded {len(texts)} chunks in {time.perf_counter() - start:.1f}s")
+    labels = np.array([faiss_id(text.metadata['chunk_id']) for text in texts], dtype=np.int64)
+
+    # Review titles make realistic short queries
+    rng = np.random.default_rng(0)
+    titles = []
+    for i in rng.permutation(len(texts)):
+        match = re.search(r"Title: (.*)", texts[i].page_content)
+        if match and match.group(1).strip() not in ('', 'None', 'nan'):
+            titles.append(match.group(1).strip())
+        if len(titles) == num_queries:
+            break
+    queries = np.asarray(embeddings.embed_documents(titles), dtype=np.float32)
+    print(f"Sampled {len(queries)} queries")
+
+    # Exact neighbours are the reference for recall
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, exact_positions = exact.search(queries, k)
+    ground_truth = labels[exact_positions]
+
+    configs = [("flat", {})]
+    configs += [("ivf", {"nprobe": nprobe}) for nprobe in (1, 4, 16, 64)]
+    configs += [("hnsw", {"ef_search": ef_search}) for ef_search in (16, 64, 128)]
+
+    # Latency is measured per query on one thread, as each request searches alone
+    faiss.omp_set_num_threads(1)
+
+    print(f"\n{'index':<8}{'params':<18}{'build s':>9}{'recall@' + str(k):>11}{'p50 ms':>9}{'p99 ms':>9}")
+    built = {}
+    for index_type, params in configs:
+        chat.index_type = index_type
+        chat.nprobe = params.get("nprobe", chat.nprobe)
+        chat.ef_search = params.get("ef_search", chat.ef_search)
+
+        # Build each index type once; only the search parameters change between rows
+        build_seconds = 0.0
+        if index_type not in built:
+            start = time.perf_counter()
+            index = chat.create_index(vectors)
+            index.add_with_ids(vectors, labels)
+            build_seconds = time.perf_counter() - start
+            built[index_type] = index
+        index = built[index_type]
+        chat.apply_search_params(index)
+
+        latencies = []
+        found = np.empty_like(ground_truth)
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            _, result = index.search(query[None, :], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found[i] = result[0]
+
+        recall = np.mean([len(set(found[i]) & set(ground_truth[i])) / k for i in range(len(queries))])
+        params_text = ", ".join(f"{name}={value}" for name, value in params.items()) or "-"
+        print(f"{index_type:<8}{params_text:<18}{build_seconds:>9.2f}{recall:>11.3f}"
+              f"{np.percentile(latencies, 50):>9.3f}{np.percentile(latencies, 99):>9.3f}")
+
+
+# Worker processes are spawned and re-import this file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bestbuy_rag import LLM_BACKENDS, QA_PROMPT, QA_PROMPT_PREFIX, BestBuyRAGChat
+
+# Backends to compare; each one loads its own copy of the model
+backends = sys.argv[1].split(',') if len(sys.argv) > 1 else LLM_BACKENDS
+
+context = (
+    "Product: Samsung Galaxy S24 (Brand: Samsung, Price: $799.99)\n"
+    "Review 1: Rating: 4/5 Battery easily lasts a full day, but the phone gets warm while gaming.\n"
+    "Review 2: Rating: 5/5 The camera is excellent in low light and the screen is very bright."
+)
+questions = [
+    "What are the most common complaints about the Samsung Galaxy S24?",
+    "How is the battery life?",
+    "Is the camera good at night?",
+    "Would you recommend it for gaming?",
+]
+# The same prompts, in the same shape stream_answer sends them, for every backend
+prompts = [QA_PROMPT.format(context=context, question=f"Question: {question}") for question in questions]
+
+print(f"{'backend':<14}{'load s':>8}{'TTFT s':>9}{'tokens':>8}{'tokens/sec':>12}")
+for backend in backends:
+    chat = BestBuyRAGChat(llm_backend=backend)
+    start = time.perf_counter()
+    chat.setup_llm()
+    load_seconds = time.perf_counter() - start
+    generator = chat.scheduler
+
+    # One untimed answer so lazy initialisation is not counted
+    generator.generate(prompts[0], QA_PROMPT_PREFIX)
+
+    first_token, tokens, seconds = [], 0, 0.0
+    for prompt in prompts:
+        start = time.perf_counter()
+        pieces = []
+        for piece in generator.stream(prompt, QA_PROMPT_PREFIX):
+            if not pieces:
+                first_token.append(time.perf_counter() - start)
+            pieces.append(piece)
+        seconds += time.perf_counter() - start
+        tokens += generator.count_tokens("".join(pieces))
+
+    print(f"{backend:<14}{load_seconds:>8.1f}{sum(first_token) / max(1, len(first_token)):>9.2f}"
+          f"{tokens:>8}{tokens / seconds:>12.1f}")
+    del chat, generator